@@ -1,3 +1,5 @@
 from .box import Box
 from .epanda import Epanda
-from .load_data import Image, load_region
+from .load_data import Image, load_region, load_regions, load_exclusions
+from .prof import batch_profile
+from .table import ProfileTable
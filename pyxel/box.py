@@ -5,7 +5,7 @@ import matplotlib.pyplot as plt
 from matplotlib.path import Path
 
 from .utils import rotate_point, get_edges
-from .prof import Region
+from .prof import Region, PixelBins
 
 class Box(Region):
     """Generate box object."""
@@ -40,29 +40,49 @@ class Box(Region):
     def make_edges(self, islog):
         return get_edges(self.height, islog)
 
-    def distribute_pixels(self, edges):
-        corners = self.get_corners()
-        reg_path = Path(corners)
-        # Get region boundaries.
+    def get_bounds(self):
+        """Get the pixel boundaries of the box.
+
+        Returns the minimum and maximum x and y pixel coordinates of the
+        smallest nonrotated rectangle that encloses the box.
+        """
+        reg_path = Path(self.get_corners())
         bounds = reg_path.get_extents().get_points()
         [[x_min_bound, y_min_bound], [x_max_bound, y_max_bound]] = bounds
         # For cases when the boundary pixels are not integers:
-        x_min_bound = floor(x_min_bound)
-        y_min_bound = floor(y_min_bound)
-        x_max_bound = ceil(x_max_bound)
-        y_max_bound = ceil(y_max_bound)
-        pixels_in_bins = []
-        for x in range(x_min_bound, x_max_bound+1):
-            for y in range(y_min_bound, y_max_bound+1):
-                if reg_path.contains_point((x, y)):
-                    x_nonrotated, y_nonrotated = rotate_point(self.x0, self.y0,
-                                                              x - self.x0,
-                                                              y - self.y0,
-                                                              -self.angle)
-                    dist_from_box_bottom = self.height/2. - \
-                                           (self.y0 - y_nonrotated)
-                    for i, edge in enumerate(edges[1:]):
-                        if edge > dist_from_box_bottom:
-                            pixels_in_bins.append((y, x, i))
-                            break
-        return pixels_in_bins
+        return floor(x_min_bound), ceil(x_max_bound), \
+               floor(y_min_bound), ceil(y_max_bound)
+
+    def distribute_pixels(self, edges, exclusions=None):
+        """Find the pixels inside each bin of the box.
+
+        Returns a `PixelBins` object containing the coordinates (row, col) of
+        the pixels whose centers are within each bin.
+
+        Pixels inside the shapes of `exclusions` (an `Exclusions` object,
+        e.g. point sources read with `load_exclusions`) are left out.
+        """
+        reg_path = Path(self.get_corners())
+        x_min_bound, x_max_bound, y_min_bound, y_max_bound = self.get_bounds()
+        # All pixels of the bounding box, ordered column by column.
+        x, y = np.meshgrid(np.arange(x_min_bound, x_max_bound+1),
+                           np.arange(y_min_bound, y_max_bound+1),
+                           indexing='ij')
+        x, y = x.ravel(), y.ravel()
+        inside = reg_path.contains_points(np.column_stack((x, y)))
+        x, y = x[inside], y[inside]
+        x_nonrotated, y_nonrotated = rotate_point(self.x0, self.y0,
+                                                  x - self.x0,
+                                                  y - self.y0,
+                                                  -self.angle)
+        dist_from_box_bottom = self.height/2. - (self.y0 - y_nonrotated)
+        # A pixel belongs to the bin of the first outer edge that lies
+        # beyond it. Pixels beyond the last edge are not binned.
+        bins = np.searchsorted(np.asarray(edges[1:]), dist_from_box_bottom,
+                               side='right')
+        in_bins = bins < len(edges) - 1
+        if exclusions is not None:
+            in_bins &= ~exclusions.is_excluded(
+                y, x, (x_min_bound, x_max_bound, y_min_bound, y_max_bound))
+        return PixelBins.from_labels(y[in_bins], x[in_bins], bins[in_bins],
+                                     edges)
@@ -0,0 +1,274 @@
+import ast
+import struct
+
+import emcee
+import numpy as np
+
+# Size of the header of the chain files, in bytes. The header is padded to
+# this size, so that it can be rewritten with a larger number of steps
+# without moving the data that follow it.
+CHAIN_HEADER_SIZE = 128
+
+CHAIN_DTYPE = np.dtype('<f8')
+
+def make_chain_header(shape):
+    """Make the fixed-size .npy header of a chain of the given shape."""
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % \
+             (CHAIN_DTYPE.str, tuple(shape))
+    prefix = np.lib.format.magic(1, 0)
+    header_len = CHAIN_HEADER_SIZE - len(prefix) - 2
+    header = header.ljust(header_len - 1) + '\n'
+    return prefix + struct.pack('<H', header_len) + header.encode('latin1')
+
+class ChainFile(object):
+    """Markov Chain stored in a .npy file that grows as steps are appended.
+
+    The chain has shape (step, walker, parameter). Each batch of steps is
+    written to the end of the file as soon as it is appended, and the header
+    is then rewritten with the new number of steps, so that the file always
+    holds a valid chain, even if the sampling is interrupted. The file can be
+    read with `np.load`, and `get_chain` memory-maps it, so that the chain
+    does not have to fit in memory.
+    """
+    def __init__(self, filename, nwalkers, ndim, nsteps=0):
+        self.filename = filename
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.nsteps = nsteps
+
+    @classmethod
+    def create(cls, filename, nwalkers, ndim):
+        """Create an empty chain file, overwriting any existing file."""
+        chain_file = cls(filename, nwalkers, ndim)
+        with open(filename, 'wb') as f:
+            f.write(make_chain_header(chain_file.shape))
+        return chain_file
+
+    @classmethod
+    def open(cls, filename):
+        """Open an existing chain file, e.g. to extend it.
+
+        Older versions saved the samples, without the burn-in, as a pickle
+        (in 'chain.dat' by default). Such files cannot be extended, since
+        the walkers cannot be told apart, and are rejected.
+        """
+        with open(filename, 'rb') as f:
+            prefix = np.lib.format.MAGIC_PREFIX
+            if f.read(len(prefix)) != prefix:
+                raise ValueError("'%s' is not a chain file. Chains that were "
+                                 "pickled by older versions cannot be "
+                                 "extended: remove the file, or pass "
+                                 "clobber_chain=True to overwrite it."
+                                 % filename)
+            f.seek(0)
+            np.lib.format.read_magic(f)
+            header_len, = struct.unpack('<H', f.read(2))
+            header = ast.literal_eval(f.read(header_len).decode('latin1'))
+            header_size = f.tell()
+        shape = header['shape']
+        if header_size != CHAIN_HEADER_SIZE or len(shape) != 3 or \
+           np.dtype(header['descr']) != CHAIN_DTYPE:
+            raise ValueError("'%s' is not a chain file." % filename)
+        nsteps, nwalkers, ndim = shape
+        # Steps that were written after the last update of the header (e.g.
+        # if the sampling was interrupted) are ignored.
+        return cls(filename, nwalkers, ndim, nsteps)
+
+    @property
+    def shape(self):
+        return (self.nsteps, self.nwalkers, self.ndim)
+
+    def append(self, positions):
+        """Append steps to the chain.
+
+        `positions` are the positions of the walkers at one step, with shape
+        (walker, parameter), or at several steps, with shape (step, walker,
+        parameter).
+        """
+        positions = np.asarray(positions, dtype=CHAIN_DTYPE)
+        positions = positions.reshape((-1, self.nwalkers, self.ndim))
+        with open(self.filename, 'r+b') as f:
+            f.seek(CHAIN_HEADER_SIZE + self.nsteps * self.nwalkers *
+                   self.ndim * CHAIN_DTYPE.itemsize)
+            f.write(positions.tobytes())
+            f.truncate()
+            f.flush()
+            self.nsteps += len(positions)
+            f.seek(0)
+            f.write(make_chain_header(self.shape))
+
+    def get_chain(self):
+        """Get a read-only, memory-mapped view of the chain."""
+        if self.nsteps == 0:
+            return np.empty(self.shape, dtype=CHAIN_DTYPE)
+        return np.memmap(self.filename, dtype=CHAIN_DTYPE, mode='r',
+                         offset=CHAIN_HEADER_SIZE, shape=self.shape)
+
+    def get_last_positions(self):
+        """Get the positions of the walkers at the last step."""
+        return np.array(self.get_chain()[-1])
+
+def sample_to_file(sampler, pos, nsteps, chain_file, save_every=10):
+    """Run an emcee sampler and append the steps to a chain file.
+
+    The positions of the walkers are appended to `chain_file` every
+    `save_every` steps, and the sampler does not store the chain itself.
+    Returns the state of the sampler after the last step, from which the
+    sampling can be continued.
+    """
+    steps = []
+    state = pos
+    for state in sampler.sample(pos, iterations=nsteps, store=False):
+        steps.append(np.array(state.coords))
+        if len(steps) == save_every:
+            chain_file.append(steps)
+            steps = []
+    if steps:
+        chain_file.append(steps)
+    return state
+
+def get_autocorr_time(chain, max_steps=5000, chunk_steps=1000):
+    """Estimate the integrated autocorrelation time of each parameter.
+
+    `chain` has shape (step, walker, parameter), and can be memory-mapped
+    (see `ChainFile.get_chain`). If it has more than `max_steps` steps, then
+    it is thinned to at most `max_steps` steps, which are read in chunks of
+    `chunk_steps`, so that the memory used does not grow with the chain. The
+    times are returned in steps of the full chain; with thinning, they are
+    only resolved to the thinning factor. The estimate is returned even if
+    the chain is too short for it to be reliable; see
+    `emcee.autocorr.integrated_time`.
+    """
+    nsteps, nwalkers, ndim = chain.shape
+    thin = max(-(-nsteps // max_steps), 1)
+    samples = np.empty((len(range(0, nsteps, thin)), nwalkers, ndim))
+    for i, start in enumerate(range(0, nsteps, chunk_steps * thin)):
+        samples[i * chunk_steps:(i + 1) * chunk_steps] = \
+            chain[start:start + chunk_steps * thin:thin]
+    return thin * emcee.autocorr.integrated_time(samples, tol=0)
+
+def has_converged(tau_history, nsteps, tau_factor=50, tau_rtol=0.01):
+    """Check whether a chain has converged.
+
+    `tau_history` holds the estimates of the autocorrelation times of the
+    parameters (see `get_autocorr_time`) made as the chain grew, the last one
+    for its current length, `nsteps`. The chain has converged if it is longer
+    than `tau_factor` autocorrelation times, and the last estimates differ
+    from the previous ones by less than `tau_rtol` (relative).
+    """
+    if len(tau_history) < 2:
+        return False
+    tau, prev_tau = tau_history[-1], tau_history[-2]
+    return bool(np.all(nsteps > tau_factor * tau) and
+                np.all(np.abs(tau - prev_tau) < tau_rtol * tau))
+
+def lerp(a, b, t):
+    """Interpolate linearly between `a` and `b`, as `np.percentile` does."""
+    diff_b_a = b - a
+    if t >= 0.5:
+        return b - diff_b_a * (1 - t)
+    return a + diff_b_a * t
+
+def get_bin_index(values, lo, hi, nbins):
+    """Get the index of the bin of each value, for `nbins` equal bins
+    between `lo` and `hi`."""
+    if hi == lo:
+        return np.zeros(len(values), dtype=np.intp)
+    with np.errstate(over='ignore'):
+        index = np.floor((values - lo) / (hi - lo) * nbins)
+    return np.clip(index, 0, nbins - 1).astype(np.intp)
+
+def chunked_percentile(chain, q, discard=0, thin=1, chunk_steps=1000,
+                       nbins=4096, max_values=100000):
+    """Compute the percentiles of the samples of a chain, in chunks of steps.
+
+    `chain` has shape (step, walker, parameter), and can be memory-mapped
+    (see `ChainFile.get_chain`). The first `discard` steps are not used, and
+    only one step in `thin` is used after them. Returns an array of shape
+    (len(q), parameter), which is the same as
+    `np.percentile(chain[discard::thin].reshape(-1, nparams), q, axis=0)`.
+
+    The chain is never read into memory as a whole. The samples that are
+    needed for each percentile are found by histogramming the chunks: the
+    bin that holds the sample of the wanted rank is split again into
+    `nbins` bins, until it has at most `max_values` samples, which are then
+    sorted. Each refinement reads the chain once, and usually one or two
+    are enough.
+    """
+    nsteps, nwalkers, ndim = chain.shape
+    nsamples = len(range(discard, nsteps, thin)) * nwalkers
+    if nsamples <= 0:
+        raise ValueError("The chain has no samples left after discarding \
+            %d steps." % discard)
+
+    def chunks():
+        for start in range(discard, nsteps, chunk_steps * thin):
+            chunk = np.asarray(chain[start:start + chunk_steps * thin:thin])
+            yield chunk.reshape((-1, ndim))
+
+    # Range of the samples of each parameter.
+    lo = np.full(ndim, np.inf)
+    hi = np.full(ndim, -np.inf)
+    for chunk in chunks():
+        lo = np.minimum(lo, chunk.min(axis=0))
+        hi = np.maximum(hi, chunk.max(axis=0))
+
+    # np.percentile interpolates between the samples of ranks floor(pos) and
+    # ceil(pos) of the sorted samples.
+    positions = (nsamples - 1) * (np.asarray(q, dtype=float) / 100.)
+    ranks = sorted(set(np.floor(positions).astype(int)) |
+                   set(np.ceil(positions).astype(int)))
+
+    # For each parameter and rank: the bins that the sample falls in at each
+    # level of refinement, as (lo, hi, bin index), and the number of
+    # samples below the current bin.
+    targets = [{'param': i, 'rank': rank, 'levels': [], 'lo': lo[i],
+                'hi': hi[i], 'n_below': 0, 'collect': False, 'value': None}
+               for i in range(ndim) for rank in ranks]
+
+    def in_bin(values, target):
+        keep = np.ones(len(values), dtype=bool)
+        for level_lo, level_hi, index in target['levels']:
+            keep &= get_bin_index(values, level_lo, level_hi, nbins) == index
+        return values[keep]
+
+    while any(target['value'] is None for target in targets):
+        pending = [target for target in targets if target['value'] is None]
+        counts = [np.zeros(nbins, dtype=np.int64) for target in pending]
+        collected = [[] for target in pending]
+        for chunk in chunks():
+            for i, target in enumerate(pending):
+                values = in_bin(chunk[:, target['param']], target)
+                if target['collect']:
+                    collected[i].append(values)
+                else:
+                    counts[i] += np.bincount(
+                        get_bin_index(values, target['lo'], target['hi'],
+                                      nbins), minlength=nbins)
+        for i, target in enumerate(pending):
+            rank = target['rank'] - target['n_below']
+            if target['collect']:
+                target['value'] = np.sort(np.concatenate(collected[i]))[rank]
+                continue
+            cum_counts = np.cumsum(counts[i])
+            index = np.searchsorted(cum_counts, rank, side='right')
+            if index > 0:
+                target['n_below'] += cum_counts[index - 1]
+            target['levels'].append((target['lo'], target['hi'], index))
+            width = (target['hi'] - target['lo']) / nbins
+            target['lo'], target['hi'] = (target['lo'] + index * width,
+                                          target['lo'] + (index + 1) * width)
+            if counts[i][index] <= max_values:
+                target['collect'] = True
+            elif target['lo'] == target['hi']:
+                target['value'] = target['lo']
+
+    values = {(target['param'], target['rank']): target['value']
+              for target in targets}
+    percentiles = np.empty((len(positions), ndim))
+    for j, position in enumerate(positions):
+        lower, upper = int(np.floor(position)), int(np.ceil(position))
+        for i in range(ndim):
+            percentiles[j, i] = lerp(values[(i, lower)], values[(i, upper)],
+                                     position - lower)
+    return percentiles
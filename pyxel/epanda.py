@@ -5,7 +5,7 @@ import matplotlib.pyplot as plt
 from matplotlib.path import Path
 
 from .utils import rotate_point, get_edges
-from .prof import Region
+from .prof import Region, PixelBins
 
 class Epanda(Region):
     """Generate elliptical sector."""
@@ -76,46 +76,101 @@ class Epanda(Region):
     def make_edges(self, islog):
         return get_edges(self.major_axis, islog)
 
-    def distribute_pixels(self, edges):
+    def get_bounds(self):
+        """Get the pixel boundaries of the elliptical sector.
+
+        Returns the minimum and maximum x and y pixel coordinates of the
+        square that encloses the full ellipse.
+        """
+        return floor(self.x0 - self.major_axis), \
+               floor(self.x0 + self.major_axis), \
+               ceil(self.y0 - self.major_axis), \
+               ceil(self.y0 + self.major_axis)
+
+    def distribute_pixels(self, edges, exclusions=None):
         """Find the pixels inside an elliptical sector annulus.
 
-        Returns an array of tuples containing the coordinates (row, col) of the
-        pixels whose centers are within a certain annulus of the elliptical
+        Returns a `PixelBins` object containing the coordinates (row, col) of
+        the pixels whose centers are within each annulus of the elliptical
         sector.
+
+        Pixels inside the shapes of `exclusions` (an `Exclusions` object,
+        e.g. point sources read with `load_exclusions`) are left out.
+        """
+        x_min_bound, x_max_bound, y_min_bound, y_max_bound = self.get_bounds()
+
+        # All pixels of the bounding square, ordered column by column.
+        x, y = np.meshgrid(np.arange(x_min_bound, x_max_bound+1),
+                           np.arange(y_min_bound, y_max_bound+1),
+                           indexing='ij')
+        x, y = x.ravel(), y.ravel()
+        x_rot_back, y_rot_back = rotate_point(self.x0, self.y0,
+                                              x - self.x0, y - self.y0,
+                                              -self.rot_angle)
+        x_rel = x_rot_back - self.x0
+        y_rel = y_rot_back - self.y0
+
+        in_sector = self.in_sector(self.get_polar_angle(x_rel, y_rel))
+        x, y = x[in_sector], y[in_sector]
+        x_rel, y_rel = x_rel[in_sector], y_rel[in_sector]
+
+        # A pixel belongs to the first annulus whose outer ellipse contains
+        # it. The annuli are found with a sorted search on the elliptical
+        # radius, and the candidates are then checked against the ellipse
+        # equation itself, so that pixels lying right on an edge are binned
+        # exactly as the ellipse equation dictates.
+        outer_edges = np.asarray(edges[2:])
+        nbins = len(outer_edges)
+        axis_ratio_sq = self.major_axis**2 / self.minor_axis**2
+        bins = np.searchsorted(outer_edges**2,
+                               x_rel**2 + y_rel**2 * axis_ratio_sq,
+                               side='right')
+
+        def in_ellipse(i):
+            edge = outer_edges[np.clip(i, 0, max(nbins - 1, 0))]
+            return x_rel**2 / edge**2 + y_rel**2 / edge**2 * \
+                self.major_axis**2 / self.minor_axis**2 < 1
+
+        if nbins > 0:
+            bins[(bins < nbins) & ~in_ellipse(bins)] += 1
+            bins[(bins > 0) & in_ellipse(bins - 1)] -= 1
+        in_bins = bins < nbins
+        if exclusions is not None:
+            in_bins &= ~exclusions.is_excluded(
+                y, x, (x_min_bound, x_max_bound, y_min_bound, y_max_bound))
+        return PixelBins.from_labels(y[in_bins], x[in_bins], bins[in_bins],
+                                     edges)
+
+    def get_polar_angle(self, x_rel, y_rel):
+        """Get the polar angles of points relative to the sector origin.
+
+        The angles are measured counter-clockwise from the major axis and
+        are in the range [0, 2*pi). Points that coincide with the origin are
+        assigned the start angle of the sector.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = np.sqrt(x_rel**2 + y_rel**2)
+            xy_angle = np.where(x_rel >= 0, np.arcsin(y_rel / r),
+                                np.arctan(y_rel / x_rel) + np.pi)
+        xy_angle[(x_rel >= 0) & (r < 1e-10)] = self.start_angle
+        xy_angle[xy_angle < 0] += 2 * np.pi
+        return xy_angle
+
+    def in_sector(self, xy_angle):
+        """Check which polar angles are within the sector.
+
+        The sector spans counter-clockwise from the start angle to the end
+        angle, so an end angle smaller than the start angle (or start and
+        end angles outside [0, 2*pi]) describe a sector that wraps past 360
+        degrees.
         """
-        pixels = []
-        x_min_bound = floor(self.x0 - self.major_axis)
-        x_max_bound = floor(self.x0 + self.major_axis)
-        y_min_bound = ceil(self.y0 - self.major_axis)
-        y_max_bound = ceil(self.y0 + self.major_axis)
-
-        for x in range(x_min_bound, x_max_bound+1):
-            for y in range(y_min_bound, y_max_bound+1):
-                x_rel = x - self.x0
-                y_rel = y - self.y0
-                x_rot_back, y_rot_back = rotate_point(self.x0, self.y0,
-                                                      x_rel, y_rel,
-                                                      -self.rot_angle)
-                outer_ellipse_eq = [(x_rot_back - self.x0)**2 / edges[i]**2 +
-                                    (y_rot_back - self.y0)**2 / edges[i]**2 *
-                                    self.major_axis**2 / self.minor_axis**2
-                                    for i in range(1,len(edges))]
-                if x_rot_back - self.x0 >= 0:
-                    r = np.sqrt((x_rot_back - self.x0)**2 + \
-                                (y_rot_back - self.y0)**2)
-                    if r < 1e-10:
-                        xy_angle = self.start_angle
-                    else:
-                        xy_angle = np.arcsin((y_rot_back - self.y0) / r)
-                    if xy_angle < 0:
-                        xy_angle = 2 * np.pi + xy_angle
-                else:
-                    xy_angle = np.arctan((y_rot_back - self.y0) /
-                                         (x_rot_back - self.x0)) + np.pi
-                if self.start_angle <= xy_angle <= self.end_angle:
-                    for i, eq in enumerate(outer_ellipse_eq[1:]):
-                        if eq < 1:
-                            pixels.append((y, x, i))
-                            break
-
-        return pixels
+        start_angle, end_angle = self.start_angle, self.end_angle
+        if end_angle - start_angle >= 2 * np.pi:
+            return np.ones_like(xy_angle, dtype=bool)
+        if 0 <= start_angle <= end_angle <= 2 * np.pi:
+            return (start_angle <= xy_angle) & (xy_angle <= end_angle)
+        start_angle = start_angle % (2 * np.pi)
+        end_angle = start_angle + (end_angle - self.start_angle) % (2 * np.pi)
+        return ((start_angle <= xy_angle) & (xy_angle <= end_angle)) | \
+               ((start_angle <= xy_angle + 2 * np.pi) &
+                (xy_angle + 2 * np.pi <= end_angle))
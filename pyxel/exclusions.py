@@ -0,0 +1,136 @@
+import numpy as np
+
+from .utils import rotate_point
+
+class Exclusions(object):
+    """Shapes excluded from the profiles, such as point sources.
+
+    Circles, ellipses, and boxes are supported. Each shape is stored by its
+    center, its two half-axes (the semi-axes of circles and ellipses, and
+    half the width and height of boxes), and its rotation angle. As for the
+    regions, 1 is subtracted from the DS9 coordinates of the centers, and the
+    rotation angles are converted from degrees to radians.
+    """
+    def __init__(self, x0, y0, half_width, half_height, angle, is_box):
+        self.x0 = np.asarray(x0, dtype=float)
+        self.y0 = np.asarray(y0, dtype=float)
+        self.half_width = np.asarray(half_width, dtype=float)
+        self.half_height = np.asarray(half_height, dtype=float)
+        self.angle = np.asarray(angle, dtype=float)
+        self.is_box = np.asarray(is_box, dtype=bool)
+        self._masks = {}
+
+    @classmethod
+    def from_region_defs(cls, reg_defs):
+        """Make exclusions from a list of DS9 (shape, params) tuples."""
+        x0, y0, half_width, half_height, angle, is_box = [], [], [], [], [], []
+        for shape, params in reg_defs:
+            x0.append(params[0] - 1)
+            y0.append(params[1] - 1)
+            if shape == 'circle':
+                half_width.append(params[2])
+                half_height.append(params[2])
+                angle.append(0.)
+            elif shape == 'ellipse':
+                half_width.append(params[2])
+                half_height.append(params[3])
+                angle.append(params[4] * np.pi / 180.)
+            elif shape == 'box':
+                half_width.append(params[2] / 2.)
+                half_height.append(params[3] / 2.)
+                angle.append(params[4] * np.pi / 180.)
+            else:
+                raise ValueError("Unsupported exclusion shape '%s'. \
+                    Excluded regions should be circles, ellipses, or \
+                    boxes." % shape)
+            is_box.append(shape == 'box')
+        return cls(x0, y0, half_width, half_height, angle, is_box)
+
+    def __len__(self):
+        return len(self.x0)
+
+    def __getstate__(self):
+        # The cached masks can be large, and are quick to make again.
+        state = self.__dict__.copy()
+        state['_masks'] = {}
+        return state
+
+    def make_mask(self, bounds):
+        """Rasterize the excluded shapes.
+
+        `bounds` are the minimum and maximum x and y pixel coordinates of the
+        mask, as returned by `get_bounds` of the regions. Returns a boolean
+        image of shape (rows, cols) that is True for the pixels whose centers
+        are inside or on the edge of any of the shapes.
+
+        All the shapes are rasterized together: the pixels in the bounding
+        boxes of all the shapes are collected in flat arrays and are tested
+        against their shapes in a single vectorized pass.
+        """
+        x_min_bound, x_max_bound, y_min_bound, y_max_bound = bounds
+        mask = np.zeros((y_max_bound - y_min_bound + 1,
+                         x_max_bound - x_min_bound + 1), dtype=bool)
+        if len(self) == 0:
+            return mask
+
+        # Bounding boxes of the shapes, clipped to the mask.
+        extent = np.where(self.is_box,
+                          np.hypot(self.half_width, self.half_height),
+                          np.maximum(self.half_width, self.half_height))
+        x_min = np.maximum(np.floor(self.x0 - extent), x_min_bound)
+        x_max = np.minimum(np.ceil(self.x0 + extent), x_max_bound)
+        y_min = np.maximum(np.floor(self.y0 - extent), y_min_bound)
+        y_max = np.minimum(np.ceil(self.y0 + extent), y_max_bound)
+        nx = np.maximum(x_max - x_min + 1, 0).astype(np.intp)
+        ny = np.maximum(y_max - y_min + 1, 0).astype(np.intp)
+        npix = nx * ny
+
+        # Pixels in the bounding boxes, and the shapes they are tested against.
+        shape_idx = np.repeat(np.arange(len(self)), npix)
+        pix_idx = np.arange(np.sum(npix)) - \
+                  np.repeat(np.cumsum(npix) - npix, npix)
+        x = x_min[shape_idx] + pix_idx % nx[shape_idx]
+        y = y_min[shape_idx] + pix_idx // nx[shape_idx]
+
+        x_rot_back, y_rot_back = rotate_point(0., 0.,
+                                              x - self.x0[shape_idx],
+                                              y - self.y0[shape_idx],
+                                              -self.angle[shape_idx])
+        half_width = self.half_width[shape_idx]
+        half_height = self.half_height[shape_idx]
+        inside = np.where(self.is_box[shape_idx],
+                          (np.abs(x_rot_back) <= half_width) &
+                          (np.abs(y_rot_back) <= half_height),
+                          (x_rot_back / half_width)**2 +
+                          (y_rot_back / half_height)**2 <= 1)
+        mask[(y[inside] - y_min_bound).astype(np.intp),
+             (x[inside] - x_min_bound).astype(np.intp)] = True
+        return mask
+
+    def get_mask(self, bounds):
+        """Get the mask of the excluded shapes within `bounds`.
+
+        The masks are cached, so the shapes are rasterized only once for
+        each field. If a mask covering a larger field (e.g., the full image)
+        has already been made, then the mask is cut out of it.
+        """
+        x_min_bound, x_max_bound, y_min_bound, y_max_bound = bounds
+        for cached_bounds, mask in self._masks.items():
+            x_min, x_max, y_min, y_max = cached_bounds
+            if x_min <= x_min_bound and x_max_bound <= x_max and \
+               y_min <= y_min_bound and y_max_bound <= y_max:
+                return mask[y_min_bound - y_min:y_max_bound - y_min + 1,
+                            x_min_bound - x_min:x_max_bound - x_min + 1]
+        mask = self.make_mask(bounds)
+        self._masks[tuple(bounds)] = mask
+        return mask
+
+    def is_excluded(self, rows, cols, bounds):
+        """Check which pixels are excluded.
+
+        `bounds` are the pixel boundaries of a region that contains all the
+        pixels, as returned by its `get_bounds` method.
+        """
+        x_min_bound, x_max_bound, y_min_bound, y_max_bound = bounds
+        mask = self.get_mask(bounds)
+        return mask[rows - y_min_bound, cols - x_min_bound]
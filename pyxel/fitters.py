@@ -1,7 +1,13 @@
-import pickle
-import os.path
+import copy
+import os
+import tempfile
+import threading
+import warnings
+from concurrent.futures import FIRST_COMPLETED, wait
 
 import numpy as np
+from scipy.optimize import brentq
+from scipy.stats import chi2
 from astropy.modeling.fitting import Fitter
 import corner
 import emcee
@@ -9,10 +15,18 @@ from astropy.modeling.fitting import (_validate_model,
                                       _fitter_to_model_params,
                                       _model_to_fit_params, Fitter,
                                       _convert_input)
+from astropy.utils.exceptions import AstropyUserWarning
 from tabulate import tabulate
 
-from .optimizers import Minimize
-from .stats import cstat
+from .chain import (ChainFile, chunked_percentile, get_autocorr_time,
+                    has_converged, sample_to_file)
+from .models import IntModel
+from .optimizers import GRADIENT_METHODS, Minimize
+from .parallel import get_pool, get_n_workers, pool_map
+from .table import ProfileTable
+from .stats import (cstat, cstat_deriv, cstat_hess, cstat_hess_from_vals,
+                    cstat_from_vals, cstat_bkg_rates,
+                    get_model_vals_and_derivs, has_derivatives)
 
 def lnprob(mc_params, model, bounds, measured_raw_cts, measured_bkg_cts, t_raw, t_bkg, x):
     min_bounds, max_bounds = bounds
@@ -27,6 +41,252 @@ def lnprob(mc_params, model, bounds, measured_raw_cts, measured_bkg_cts, t_raw,
     lnc = cstat(measured_raw_cts, model, measured_bkg_cts, t_raw, t_bkg, x)
     return lnp - lnc
 
+def get_batch_model_vals(model, mc_params, x):
+    """Evaluate a model for several sets of fitted parameters.
+
+    `mc_params` is a (sets x fitted parameters) array. Returns a (sets x x)
+    array. The model is evaluated for all the sets in a single call, with
+    the parameters as columns that broadcast against x, if it supports it.
+    Otherwise, and for models with tied parameters, the sets are evaluated
+    one at a time.
+    """
+    if not any(model.tied.values()):
+        params = np.repeat(model.parameters[np.newaxis], len(mc_params),
+                           axis=0)
+        params[:, get_free_params(model)] = mc_params
+        try:
+            model_vals = model.evaluate(x, *params.T[..., np.newaxis])
+        except (ValueError, TypeError):
+            model_vals = None
+        if np.shape(model_vals) == (len(mc_params), len(x)):
+            return np.asarray(model_vals, dtype=float)
+    model_vals = []
+    for params in mc_params:
+        _fitter_to_model_params(model, params)
+        model_vals.append(model(x))
+    return np.array(model_vals, dtype=float).reshape(len(mc_params), len(x))
+
+def batch_lnprob(mc_params, model, bounds, measured_raw_cts, measured_bkg_cts, t_raw, t_bkg, x):
+    """Same as `lnprob`, for a (walkers x parameters) array of positions.
+
+    The bounds are checked for all the walkers at once, and the model and
+    the C-statistic are evaluated for all the walkers within the bounds
+    together (see `get_batch_model_vals`). Returns one value per walker.
+    """
+    mc_params = np.atleast_2d(mc_params)
+    min_bounds, max_bounds = [np.asarray(b, dtype=float) for b in bounds]
+    in_bounds = np.all((np.isnan(min_bounds) | (mc_params >= min_bounds)) &
+                       (np.isnan(max_bounds) | (mc_params <= max_bounds)),
+                       axis=1)
+    lnprobs = np.full(len(mc_params), -np.inf)
+    if not np.any(in_bounds):
+        return lnprobs
+    model_vals = get_batch_model_vals(model, mc_params[in_bounds], x)
+    lnprobs[in_bounds] = -cstat_from_vals(measured_raw_cts, model_vals,
+                                          measured_bkg_cts, t_raw, t_bkg)
+    return lnprobs
+
+# Arguments of `lnprob` stored in each worker by `init_lnprob_worker`.
+lnprob_worker = threading.local()
+
+def init_lnprob_worker(model, bounds, measured_raw_cts, measured_bkg_cts,
+                       t_raw, t_bkg, x):
+    """Store the model and the data in a worker, once, so that only the
+    parameters are sent to the worker for each call of `worker_lnprob`.
+
+    The model is copied, since the workers of a pool of threads would
+    otherwise set the parameters of the same model.
+    """
+    lnprob_worker.args = (model.copy(), bounds, measured_raw_cts, measured_bkg_cts,
+                          t_raw, t_bkg, x)
+
+def worker_lnprob(mc_params):
+    """Same as `batch_lnprob`, with the arguments stored by
+    `init_lnprob_worker`."""
+    return batch_lnprob(mc_params, *lnprob_worker.args)
+
+# Fitter, model, and data stored in each worker by `init_bootstrap_worker`.
+bootstrap_worker = threading.local()
+
+def init_bootstrap_worker(optimizer, model, x, t_raw, t_bkg, fit_kwargs):
+    """Store a fitter, the model, and the data in a worker, once, so that
+    only the simulated counts are sent to the worker for each call of
+    `worker_bootstrap_fit`.
+
+    Each worker makes its own fitter, with its own copy of the optimizer,
+    since fitters cache the last model values.
+    """
+    bootstrap_worker.fitter = CstatFitter(copy.deepcopy(optimizer))
+    bootstrap_worker.args = (model.copy(), x, t_raw, t_bkg, fit_kwargs)
+
+def worker_bootstrap_fit(measured_raw_cts, measured_bkg_cts):
+    """Fit the model stored by `init_bootstrap_worker` to simulated counts.
+
+    The fit starts from the parameters of the stored model. Returns the
+    fitted parameters, and whether the optimizer reported success.
+    """
+    model, x, t_raw, t_bkg, fit_kwargs = bootstrap_worker.args
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', AstropyUserWarning)
+        fitted_model = bootstrap_worker.fitter(model, x, measured_raw_cts,
+                                               measured_bkg_cts, t_raw, t_bkg,
+                                               **fit_kwargs)
+    fitparams, _ = _model_to_fit_params(fitted_model)
+    success = bootstrap_worker.fitter.fit_info.get('exit_mode', 0) == 0
+    return fitparams, success
+
+# Fitter, model, and data stored in each worker by `init_profile_worker`.
+profile_worker = threading.local()
+
+def init_profile_worker(optimizer, model, x, measured_raw_cts,
+                        measured_bkg_cts, t_raw, t_bkg, fit_kwargs):
+    """Store a fitter, the best-fit model, and the data in a worker, once,
+    for the scans of `worker_profile_scan`."""
+    profile_worker.fitter = CstatFitter(copy.deepcopy(optimizer))
+    profile_worker.args = (model.copy(), x, measured_raw_cts,
+                           measured_bkg_cts, t_raw, t_bkg, fit_kwargs)
+
+def profile_cstat(param_name, value, start_model):
+    """Minimize the C-statistic with one parameter fixed at `value`.
+
+    The other free parameters are fitted, starting from their values in
+    `start_model`, which has `param_name` fixed. Uses the fitter and the data
+    stored by `init_profile_worker`. Returns the minimum C-statistic and the
+    fitted model.
+    """
+    _, x, measured_raw_cts, measured_bkg_cts, t_raw, t_bkg, fit_kwargs = \
+        profile_worker.args
+    model = start_model.copy()
+    setattr(model, param_name, value)
+    if np.any(get_free_params(model)):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', AstropyUserWarning)
+            model = profile_worker.fitter(model, x, measured_raw_cts,
+                                          measured_bkg_cts, t_raw, t_bkg,
+                                          **fit_kwargs)
+    stat = cstat(measured_raw_cts, model, measured_bkg_cts, t_raw, t_bkg, x)
+    return stat, model
+
+def worker_profile_scan(param_name, step, max_steps, threshold):
+    """Scan the profile likelihood of one parameter in one direction.
+
+    The parameter stored by `init_profile_worker` is stepped away from its
+    best-fit value by `step` (which is negative to scan downwards), and the
+    other parameters are refitted at each step, starting from the fit at
+    the previous step. The scan stops once the C-statistic has increased by
+    `threshold` from its minimum, and the crossing is then found by
+    refitting between the last two steps. Returns the values of the
+    parameter, the increases of the C-statistic, and the crossing, which is
+    NaN if it was not reached within `max_steps` steps or the bounds of the
+    parameter.
+    """
+    model, x, measured_raw_cts, measured_bkg_cts, t_raw, t_bkg, _ = \
+        profile_worker.args
+    model = model.copy()
+    getattr(model, param_name).fixed = True
+    best_value = getattr(model, param_name).value
+    min_stat = cstat(measured_raw_cts, model, measured_bkg_cts, t_raw, t_bkg,
+                     x)
+    min_bound, max_bound = model.bounds[param_name]
+
+    values = [best_value]
+    delta_stats = [0.]
+    crossing = np.nan
+    start_model = model
+    for i in range(1, max_steps + 1):
+        value = best_value + i * step
+        if min_bound is not None:
+            value = max(value, min_bound)
+        if max_bound is not None:
+            value = min(value, max_bound)
+        if value == values[-1]:
+            break
+        stat, fitted_model = profile_cstat(param_name, value, start_model)
+        values.append(value)
+        delta_stats.append(stat - min_stat)
+        if delta_stats[-1] >= threshold:
+            crossing = brentq(
+                lambda v: profile_cstat(param_name, v, start_model)[0] -
+                          min_stat - threshold,
+                values[-2], values[-1], xtol=1e-3 * abs(step))
+            break
+        start_model = fitted_model
+    return np.array(values), np.array(delta_stats), crossing
+
+# Fitter stored in each worker by `init_batch_worker`.
+batch_worker = threading.local()
+
+def init_batch_worker(optimizer, fit_kwargs):
+    """Store a fitter in a worker, once, for the fits of
+    `worker_batch_fit`."""
+    batch_worker.fitter = CstatFitter(copy.deepcopy(optimizer))
+    batch_worker.fit_kwargs = fit_kwargs
+
+def worker_batch_fit(model, x, measured_raw_cts, measured_bkg_cts, t_raw,
+                     t_bkg, x_err):
+    """Fit a model to one profile, with the fitter stored by
+    `init_batch_worker`.
+
+    Returns the fitted parameters, their uncertainties from the Hessian (see
+    `CstatFitter.__call__`), the C-statistic, the exit mode and the number
+    of iterations reported by the optimizer, and an error message, which is
+    empty if the fit ran. Only numerical failures of the fit are caught: the
+    parameters are then NaN, the exit mode is -1, and the message is that of
+    the exception. Other errors are raised.
+    """
+    fitter = batch_worker.fitter
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', AstropyUserWarning)
+            fitted_model = fitter(model, x, measured_raw_cts,
+                                  measured_bkg_cts, t_raw, t_bkg,
+                                  x_err=x_err, **batch_worker.fit_kwargs)
+    except (RuntimeError, FloatingPointError, np.linalg.LinAlgError) as e:
+        nan_params = np.full(len(model.parameters), np.nan)
+        return (nan_params, nan_params, np.nan, -1, -1,
+                '%s: %s' % (type(e).__name__, e))
+    param_errs = np.full(len(model.parameters), np.nan)
+    param_errs[get_free_params(fitted_model)] = fitter.fit_info['param_errs']
+    stat = cstat(measured_raw_cts, fitted_model, measured_bkg_cts, t_raw,
+                 t_bkg, x)
+    numiter = fitter.fit_info.get('numiter')
+    return (fitted_model.parameters, param_errs, stat,
+            fitter.fit_info.get('exit_mode', 0),
+            -1 if numiter is None else numiter, '')
+
+def get_fit_data(par_names, percentiles):
+    """Make the fit summary from the lower, median, and upper percentiles of
+    the parameters.
+
+    Returns one row (parameter, value, lower uncertainty, upper uncertainty)
+    for each parameter, where the value is the median, and the lower
+    uncertainty is negative.
+    """
+    return [[par_names[i], median, lower - median, upper - median]
+            for i, (lower, median, upper) in enumerate(zip(*percentiles))]
+
+def print_fit_summary(fit_data, floatfmt=".3e", tablefmt='orgtbl'):
+    """Print the fit summary made by `get_fit_data`."""
+    print('\n'*2)
+    print('FIT SUMMARY:')
+    print('')
+    tab_headers = ['Parameter', 'Value',
+                   'Lower Uncertainty', 'Upper Uncertainty']
+    print(tabulate(fit_data, headers=tab_headers, tablefmt=tablefmt,
+                   floatfmt=floatfmt))
+
+def get_free_params(model):
+    """Get a boolean mask of the parameters of a model that are fitted,
+    i.e. that are neither fixed nor tied."""
+    return np.array([not model.fixed[name] and not model.tied[name]
+                     for name in model.param_names], dtype=bool)
+
+def make_opt_func(optimizer):
+    """Wrap an optimizer object in a function, as expected by `Fitter`."""
+    def opt_func(*args, **kwargs):
+        return optimizer(*args, **kwargs)
+    return opt_func
+
 class CstatFitter(Fitter):
     """
     Fit a model using the C-statistic. [1][2]
@@ -37,6 +297,27 @@ class CstatFitter(Fitter):
         one of the classes in optimizers.py or in astropy.modeling.optimizers
         (default: Minimize)
 
+    The gradient of the statistic (and its Hessian, for the optimizers that
+    use it) is only given to the optimizer if the model has derivatives (a
+    `fit_deriv` or an `evaluate_with_derivatives` method), so that
+    Minimize() falls back to a derivative-free method for other models.
+    If the optimizer uses the gradient of the statistic, then the model values
+    and derivatives are calculated together (with the model's
+    `evaluate_with_derivatives`, if it has one) and are cached for the last
+    set of parameters, so that the statistic and its gradient at the same
+    parameters share a single evaluation of the model.
+
+    After a fit, `fit_info` also contains the Hessian of the C-statistic at
+    the best-fit parameters ('hessian', see `stats.cstat_hess`), the
+    covariance matrix of the fitted parameters ('param_cov'), and their
+    symmetric 1-sigma uncertainties ('param_errs'). Since the C-statistic is
+    -2 log(likelihood), the covariance matrix is twice the inverse of the
+    Hessian. These uncertainties take seconds to compute, and are a quick
+    alternative to `mcmc_err`. They need the derivatives of the model (its
+    `fit_deriv` or `evaluate_with_derivatives`), and are NaN for models
+    without them. Optimizers that use the Hessian (e.g.
+    Minimize('trust-ncg')) are also given it.
+
     .. [1] Cash, W. (1979), "Parameter estimation in astronomy through
            application of the likelihood ratio", ApJ, 228, p. 939-947
     .. [2] Wachter, K., Leach, R., Kellogg, E. (1979), "Parameter estimation
@@ -48,15 +329,35 @@ class CstatFitter(Fitter):
         if optimizer is None:
             optimizer = Minimize()
 
-        def opt_func(*args, **kwargs):
-            return optimizer(*args, **kwargs)
+        self._optimizer = optimizer
+        self._uses_hess = getattr(optimizer, 'uses_hess', False)
+        self._uses_jac = False
+        self._last_eval = None
+        super(CstatFitter, self).__init__(make_opt_func(optimizer),
+                                          statistic=cstat)
+
+    def __getstate__(self):
+        # The optimizer is wrapped in a local function, which cannot be
+        # pickled, so the wrapper is made again when the fitter is unpickled
+        # (e.g. in a worker process).
+        state = self.__dict__.copy()
+        del state['_opt_method']
+        state['_last_eval'] = None
+        return state
 
-        super(CstatFitter, self).__init__(opt_func, statistic=cstat)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._opt_method = make_opt_func(self._optimizer)
 
     def __call__(self, model, x, measured_raw_cts, measured_bkg_cts,
                  t_raw, t_bkg, x_err=None, **kwargs):
         if x_err is not None:
-            model = IntModel(model.__class__)(x_err, *model.parameters)
+            # The integration order must be given for the parameters to be
+            # passed positionally. The constraints are copied, since they are
+            # not part of the parameter values.
+            model = IntModel(model.__class__)(
+                x_err, 5, *model.parameters, fixed=model.fixed,
+                bounds=model.bounds, tied=model.tied)
 
         model_copy = _validate_model(model,
                                      self.supported_constraints)
@@ -64,32 +365,146 @@ class CstatFitter(Fitter):
         farg = (model_copy, measured_bkg_cts, t_raw, t_bkg) + farg
         p0, _ = _model_to_fit_params(model_copy)
 
-        # TODO: Honor estimate_jacobian in kwargs, and/or determine if
-        # model supports jacobian, and/or if fitter supports the jac argument.
-
-        fitparams, self.fit_info = self._opt_method(
-            self.objective_function, p0, farg, jac=self.objective_derivative,
-            **kwargs)
+        # The gradient and the Hessian are only given to the optimizer if the
+        # model has derivatives.
+        with_derivs = has_derivatives(model_copy)
+        if with_derivs:
+            kwargs['jac'] = self.objective_derivative
+            if self._uses_hess:
+                kwargs['hess'] = self.objective_hessian
+        if hasattr(self._optimizer, 'get_method'):
+            self._uses_jac = self._optimizer.get_method(kwargs.get('jac')) \
+                in GRADIENT_METHODS
+        else:
+            self._uses_jac = getattr(self._optimizer, 'uses_jac', False)
+        self._uses_jac = self._uses_jac and with_derivs
+        try:
+            fitparams, fit_info = self._opt_method(
+                self.objective_function, p0, farg, **kwargs)
+            self.fit_info = dict(fit_info)
+            if with_derivs:
+                hess = self.objective_hessian(fitparams, *farg)
+            else:
+                hess = np.full((len(p0), len(p0)), np.nan)
+        finally:
+            self.clear_cache()
         _fitter_to_model_params(model_copy, fitparams)
 
+        self.fit_info['hessian'] = hess
+        try:
+            param_cov = 2. * np.linalg.inv(hess)
+        except np.linalg.LinAlgError:
+            param_cov = np.full_like(hess, np.nan)
+        with np.errstate(invalid='ignore'):
+            param_errs = np.sqrt(np.diag(param_cov))
+        if with_derivs and not np.all(np.isfinite(param_errs)):
+            warnings.warn("The covariance matrix of the parameters could not "
+                          "be estimated; the Hessian of the statistic is "
+                          "singular or not positive definite.",
+                          AstropyUserWarning)
+        self.fit_info['param_cov'] = param_cov
+        self.fit_info['param_errs'] = param_errs
+
         return model_copy
 
-    def objective_derivative(self, params, model, measured_bkg_cts, t_raw, t_bkg, x, measured_raw_cts):
+    def clear_cache(self):
+        """Forget the model values cached for the last parameters."""
+        self._last_eval = None
+
+    def evaluate_model(self, params, model, x, with_derivs):
+        """Evaluate the model at `params`.
+
+        Returns the model values and, if `with_derivs` is True, the model
+        derivatives (otherwise None). The values and derivatives are reused
+        if the model was last evaluated at the same parameters.
+        """
+        params = np.array(params, dtype=float)
+        # The cache is replaced as a whole, so that it stays consistent when
+        # the fitter is used from several threads (with a copy of the model
+        # each, see `optimizers.Minimize`).
+        last_eval = self._last_eval
+        if last_eval is not None:
+            last_params, last_model, last_vals = last_eval
+            if last_model is model and \
+               np.array_equal(params, last_params) and \
+               (last_vals[1] is not None or not with_derivs):
+                return last_vals
         _fitter_to_model_params(model, params)
+        if with_derivs:
+            model_vals = get_model_vals_and_derivs(model, x)
+        else:
+            model_vals = (model(x), None)
+        self._last_eval = (params, model, model_vals)
+        return model_vals
+
+    def objective_function(self, params, model, measured_bkg_cts, t_raw, t_bkg, x, measured_raw_cts):
+        model_vals, _ = self.evaluate_model(params, model, x, self._uses_jac)
+        return cstat(measured_raw_cts, model, measured_bkg_cts,
+                     t_raw, t_bkg, x, model_vals=model_vals)
+
+    def objective_derivative(self, params, model, measured_bkg_cts, t_raw, t_bkg, x, measured_raw_cts):
+        model_vals, model_derivs = self.evaluate_model(params, model, x, True)
         return cstat_deriv(measured_raw_cts, model, measured_bkg_cts,
-                           t_raw, t_bkg, x)
+                           t_raw, t_bkg, x, model_vals=model_vals,
+                           model_derivs=model_derivs[get_free_params(model)])
+
+    def objective_hessian(self, params, model, measured_bkg_cts, t_raw, t_bkg, x, measured_raw_cts):
+        model_vals, model_derivs = self.evaluate_model(params, model, x, True)
+        return cstat_hess(measured_raw_cts, model, measured_bkg_cts,
+                          t_raw, t_bkg, x, model_vals=model_vals,
+                          model_derivs=model_derivs[get_free_params(model)])
 
     def mcmc_err(self, model, x, measured_raw_cts, measured_bkg_cts,
                  t_raw, t_bkg, cl=68.27, nruns=500, nwalkers=100, nburn=100,
                  with_corner=True, corner_filename='triangle.pdf',
                  corner_dpi=144, clobber_corner=True, save_chain=False,
-                 chain_filename='chain.dat', clobber_chain=True,
-                 floatfmt=".3e", tablefmt='orgtbl', **kwargs):
+                 chain_filename='chain.npy', clobber_chain=True,
+                 floatfmt=".3e", tablefmt='orgtbl', n_jobs=None,
+                 backend='process', save_every=10, until_converged=False,
+                 check_every=100, tau_factor=50, tau_rtol=0.01, **kwargs):
         """Run Markov Chain Monte Carlo for parameter error estimation.
 
         `model` should be a fitted model as returned by `__call__`.
 
-        Return the Markov Chain as a 3-dimensional array (walker, step, parameter).
+        The likelihood of all the walkers is evaluated together at each step
+        (see `batch_lnprob`), using the vectorized mode of emcee. It can also
+        be evaluated in a pool of `n_jobs` workers (one per CPU if negative),
+        either processes or threads depending on `backend`, in which case
+        the walkers are split into one batch per worker. By default, it is
+        evaluated serially. Each worker receives the model and the data only
+        once, when it starts, and then only the positions of the walkers are
+        sent to it.
+
+        The chain is written to disk as it is sampled, every `save_every`
+        steps, in a `ChainFile` (a .npy file of shape (step, walker,
+        parameter)). If `save_chain` is True, then it is kept in
+        `chain_filename`, otherwise it is written to a temporary file that is
+        removed at the end. If `chain_filename` already exists and
+        `clobber_chain` is False, then the chain in it is extended: the
+        walkers start from their last saved positions, and are run until the
+        chain has `nruns` steps in total. This also resumes a run that was
+        interrupted. Chains that were pickled by older versions (in
+        'chain.dat' by default) cannot be extended, and raise a ValueError.
+        The percentiles are computed from the file in chunks
+        (see `chunked_percentile`), so the chain is never held in memory as
+        a whole.
+
+        If `until_converged` is True, then `nruns` is the maximum number of
+        steps. The integrated autocorrelation time of each parameter is
+        estimated every `check_every` steps, and the sampling stops once the
+        chain is longer than `tau_factor` times the autocorrelation time of
+        every parameter and the estimates changed by less than `tau_rtol`
+        (relative) since the last check. The burn-in is then set to twice the
+        longest autocorrelation time, and the chain is thinned by half the
+        shortest one, instead of using `nburn`. The autocorrelation times
+        are estimated from at most a fixed number of steps of the chain (see
+        `get_autocorr_time`), and are printed and stored in `mcmc_info`
+        together with whether the chain converged. In both modes, the number
+        of steps, the burn-in and the thinning are printed and stored in
+        `mcmc_info`.
+
+        Return the fit summary, with one row (parameter, value, lower
+        uncertainty, upper uncertainty) for each free parameter.
         """
         model_copy = _validate_model(model,
                                      self.supported_constraints)
@@ -106,49 +521,424 @@ class CstatFitter(Fitter):
         pos = [params + 1e-4 * np.random.randn(ndim) * params
                for i in range(nwalkers)]
 
-        if not os.path.isfile(chain_filename) or clobber_chain:
-            sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, threads=8,
-                                            args=(model_copy, (min_bounds, max_bounds),
-                                                  measured_raw_cts, measured_bkg_cts, t_raw, t_bkg, x))
-            sampler.run_mcmc(pos, nruns)
-            samples = sampler.chain[:, nburn:, :].reshape((-1, ndim))
-
-            #samples = np.array(result).reshape((-1, ndim))
-            if save_chain:
-                with open(chain_filename, 'wb') as f:
-                    pickle.dump(samples, f)
-        elif os.path.isfile(chain_filename) and not clobber_chain:
-            with open(chain_filename, 'rb') as f:
-                samples = pickle.load(f)
-
-        par_names = model_copy.param_names
-        free_par_names = []
-        for par_name in par_names:
-            is_fixed = getattr(model_copy, par_name).fixed
-            if not is_fixed:
-                free_par_names.append(par_name)
-        if with_corner:
-            if os.path.isfile(corner_filename) and not clobber_corner:
-                raise Exception("Corner plot already exists and clobber_corner=False.")
+        tmp_filename = None
+        if os.path.isfile(chain_filename) and not clobber_chain:
+            chain_file = ChainFile.open(chain_filename)
+            if chain_file.nwalkers != nwalkers or chain_file.ndim != ndim:
+                raise ValueError("The chain in '%s' has %d walkers and %d \
+                    parameters, instead of %d and %d." %
+                    (chain_filename, chain_file.nwalkers, chain_file.ndim,
+                     nwalkers, ndim))
+            if chain_file.nsteps > 0:
+                pos = chain_file.get_last_positions()
+        elif save_chain:
+            chain_file = ChainFile.create(chain_filename, nwalkers, ndim)
+        else:
+            fd, tmp_filename = tempfile.mkstemp(prefix='pyxel_chain_',
+                                                suffix='.npy')
+            os.close(fd)
+            chain_file = ChainFile.create(tmp_filename, nwalkers, ndim)
+
+        # The temporary chain file is removed even if the sampling fails or
+        # is interrupted.
+        try:
+            tau_history = []
+            if chain_file.nsteps < nruns:
+                lnprob_args = (model_copy, (min_bounds, max_bounds),
+                               measured_raw_cts, measured_bkg_cts, t_raw,
+                               t_bkg, x)
+                pool = get_pool(n_jobs, backend,
+                                initializer=init_lnprob_worker,
+                                initargs=lnprob_args)
+
+                def run_sampler(sampler):
+                    # In the convergence-monitoring mode, the chain is sampled
+                    # in blocks of `check_every` steps, and the
+                    # autocorrelation time is estimated after each block.
+                    state = pos
+                    while chain_file.nsteps < nruns:
+                        nsteps = nruns - chain_file.nsteps
+                        if until_converged:
+                            nsteps = min(nsteps, check_every)
+                        state = sample_to_file(sampler, state, nsteps,
+                                               chain_file, save_every)
+                        if until_converged:
+                            tau_history.append(
+                                get_autocorr_time(chain_file.get_chain()))
+                            if has_converged(tau_history, chain_file.nsteps,
+                                             tau_factor, tau_rtol):
+                                break
+
+                if pool is None:
+                    sampler = emcee.EnsembleSampler(nwalkers, ndim,
+                                                    batch_lnprob,
+                                                    args=lnprob_args,
+                                                    vectorize=True)
+                    run_sampler(sampler)
+                else:
+                    n_workers = get_n_workers(n_jobs)
+
+                    def pool_lnprob(mc_params):
+                        batches = np.array_split(mc_params, n_workers)
+                        return np.concatenate(pool_map(pool, worker_lnprob,
+                                                       batches))
+
+                    with pool:
+                        sampler = emcee.EnsembleSampler(nwalkers, ndim,
+                                                        pool_lnprob,
+                                                        vectorize=True)
+                        run_sampler(sampler)
+            chain = chain_file.get_chain()
+
+            self.mcmc_info = {'nsteps': chain_file.nsteps}
+            if until_converged:
+                if tau_history:
+                    tau = tau_history[-1]
+                    converged = has_converged(tau_history, chain_file.nsteps,
+                                              tau_factor, tau_rtol)
+                else:
+                    # The chain already had `nruns` steps. The stability of
+                    # the estimates is only checked while sampling.
+                    tau = get_autocorr_time(chain)
+                    converged = bool(chain_file.nsteps >
+                                     tau_factor * np.max(tau))
+                self.mcmc_info.update({'autocorr_time': tau,
+                                       'converged': converged})
+                nburn = min(int(2. * np.max(tau)), chain_file.nsteps - 1)
+                thin = max(int(0.5 * np.min(tau)), 1)
+                if not converged:
+                    warnings.warn("The chain did not converge in %d steps: "
+                                  "it is %.1f autocorrelation times long. The "
+                                  "errors may be unreliable."
+                                  % (chain_file.nsteps,
+                                     chain_file.nsteps / np.max(tau)),
+                                  AstropyUserWarning)
             else:
-                fig = corner.corner(samples, labels=free_par_names, bins=[20]*ndim)
-                fig.savefig(corner_filename, dpi=corner_dpi)
+                thin = 1
+            self.mcmc_info.update({'nburn': nburn, 'thin': thin})
+
+            par_names = model_copy.param_names
+            free_par_names = []
+            for par_name in par_names:
+                is_fixed = getattr(model_copy, par_name).fixed
+                if not is_fixed:
+                    free_par_names.append(par_name)
+            if with_corner:
+                if os.path.isfile(corner_filename) and not clobber_corner:
+                    raise Exception("Corner plot already exists and clobber_corner=False.")
+                else:
+                    samples = chain[nburn::thin].reshape((-1, ndim))
+                    fig = corner.corner(samples, labels=free_par_names, bins=[20]*ndim)
+                    fig.savefig(corner_filename, dpi=corner_dpi)
+            lim_lower = 50. - cl / 2.
+            lim_upper = 50. + cl / 2.
+
+            fit_data = get_fit_data(free_par_names, chunked_percentile(
+                chain, [lim_lower, 50., lim_upper], nburn, thin))
+        finally:
+            if tmp_filename is not None:
+                os.remove(tmp_filename)
+
+        print_fit_summary(fit_data, floatfmt, tablefmt)
+        print('')
+        print('MCMC DIAGNOSTICS:')
+        print('')
+        if until_converged:
+            print(tabulate([[free_par_names[i], tau[i],
+                             chain_file.nsteps / tau[i]]
+                            for i in range(ndim)],
+                           headers=['Parameter', 'Autocorrelation Time',
+                                    'Steps / Autocorrelation Time'],
+                           tablefmt=tablefmt, floatfmt=".1f"))
+            print('')
+            print('Steps: %d, burn-in: %d, thinning: %d, converged: %s'
+                  % (chain_file.nsteps, nburn, thin, converged))
+        else:
+            print('Steps: %d, burn-in: %d, thinning: %d'
+                  % (chain_file.nsteps, nburn, thin))
+        print('\n'*2)
+
+        return fit_data
+
+    def bootstrap_err(self, model, x, measured_raw_cts, measured_bkg_cts,
+                      t_raw, t_bkg, cl=68.27, nboot=1000, floatfmt=".3e",
+                      tablefmt='orgtbl', n_jobs=None, backend='process',
+                      seed=None, **kwargs):
+        """Run a parametric (Poisson) bootstrap for parameter error
+        estimation.
+
+        `model` should be a fitted model as returned by `__call__`.
+
+        `nboot` sets of source and background counts are drawn from Poisson
+        distributions whose means are the counts expected from the model and
+        from the background rates that maximize the likelihood (see
+        `stats.cstat_bkg_rates`), for the exposures `t_raw` and `t_bkg`. The
+        model is refitted to each set, starting from its best-fit
+        parameters, and the errors are given by the percentiles of the
+        refitted parameters. `kwargs` are passed to the fits.
+
+        The fits are independent, and can be run in a pool of `n_jobs`
+        workers (one per CPU if negative), either processes or threads
+        depending on `backend`. By default, they are run serially. The
+        counts are drawn before the fits are started, from a
+        `np.random.RandomState` seeded with `seed`, so the results do not
+        depend on the number of workers, and are reproducible if `seed` is
+        given.
+
+        Return the fit summary in the same format as `mcmc_err`. The refitted
+        parameters and the number of fits that the optimizer did not report
+        as successful are stored in `bootstrap_info`.
+        """
+        model_copy = _validate_model(model, self.supported_constraints)
+        measured_raw_cts = np.asarray(measured_raw_cts, dtype=float)
+        measured_bkg_cts = np.asarray(measured_bkg_cts, dtype=float)
+        t_raw = np.asarray(t_raw, dtype=float)
+        t_bkg = np.asarray(t_bkg, dtype=float)
+
+        model_vals = np.asarray(model_copy(x), dtype=float)
+        bkg_rates = cstat_bkg_rates(measured_raw_cts, model_vals,
+                                    measured_bkg_cts, t_raw, t_bkg)
+        random_state = np.random.RandomState(seed)
+        sim_raw_cts = random_state.poisson(
+            t_raw * np.maximum(model_vals + bkg_rates, 0.),
+            (nboot, len(t_raw))).astype(float)
+        sim_bkg_cts = random_state.poisson(
+            t_bkg * bkg_rates, (nboot, len(t_bkg))).astype(float)
+
+        init_args = (self._optimizer, model_copy, x, t_raw, t_bkg, kwargs)
+        pool = get_pool(n_jobs, backend, initializer=init_bootstrap_worker,
+                        initargs=init_args)
+        if pool is None:
+            init_bootstrap_worker(*init_args)
+            results = pool_map(None, worker_bootstrap_fit, sim_raw_cts,
+                               sim_bkg_cts)
+        else:
+            with pool:
+                results = pool_map(pool, worker_bootstrap_fit, sim_raw_cts,
+                                   sim_bkg_cts)
+        boot_params = np.array([params for params, _ in results])
+        n_failed = sum(not success for _, success in results)
+        if n_failed > 0:
+            warnings.warn("%d of the %d bootstrap fits may be unsuccessful."
+                          % (n_failed, nboot), AstropyUserWarning)
+        self.bootstrap_info = {'params': boot_params, 'n_failed': n_failed}
+
+        free_par_names = [name for name, is_free in
+                          zip(model_copy.param_names,
+                              get_free_params(model_copy)) if is_free]
         lim_lower = 50. - cl / 2.
         lim_upper = 50. + cl / 2.
+        fit_data = get_fit_data(free_par_names, np.percentile(
+            boot_params, [lim_lower, 50., lim_upper], axis=0))
 
-        val_with_errs = [(v[1], v[1]-v[0], v[2]-v[1])
-                         for v in zip(*np.percentile(samples,
-                                      [lim_lower, 50., lim_upper], axis=0))]
-        fit_data = [[free_par_names[i], val_with_errs[i][0], -val_with_errs[i][1],
-                     val_with_errs[i][2]] for i in range(len(val_with_errs))]
-
+        print_fit_summary(fit_data, floatfmt, tablefmt)
         print('\n'*2)
-        print('FIT SUMMARY:')
-        print('')
-        tab_headers = ['Parameter', 'Value',
-                       'Lower Uncertainty', 'Upper Uncertainty']
-        print(tabulate(fit_data, headers=tab_headers, tablefmt=tablefmt,
-                       floatfmt=floatfmt))
+
+        return fit_data
+
+    def profile_err(self, model, x, measured_raw_cts, measured_bkg_cts,
+                    t_raw, t_bkg, cl=68.27, step=0.5, max_steps=20,
+                    floatfmt=".3e", tablefmt='orgtbl', n_jobs=None,
+                    backend='process', **kwargs):
+        """Compute profile-likelihood confidence intervals of the parameters.
+
+        `model` should be a fitted model as returned by `__call__`.
+
+        Each free parameter is stepped away from its best-fit value, both
+        upwards and downwards, while the other free parameters are refitted
+        at each step, starting from the fit at the previous step. The limits
+        of the interval are where the C-statistic has increased from its
+        minimum by the quantile of the chi-square distribution with one
+        degree of freedom at `cl` (1 for cl=68.27), see
+        `worker_profile_scan`. The steps are `step` times the symmetric
+        uncertainties given by the Hessian (see `__call__`), and at most
+        `max_steps` steps are made in each direction. `kwargs` are passed to
+        the fits.
+
+        The scans are independent, and can be run in a pool of `n_jobs`
+        workers (one per CPU if negative), either processes or threads
+        depending on `backend`. By default, they are run serially.
+
+        Return the fit summary in the same format as `mcmc_err`, with the
+        best-fit values and the asymmetric uncertainties. The uncertainties
+        are NaN on the sides where the limit was not reached. The scanned
+        values of each parameter and the corresponding increases of the
+        C-statistic are stored in `profile_info`.
+        """
+        model_copy = _validate_model(model, self.supported_constraints)
+        free_params = get_free_params(model_copy)
+        free_par_names = [name for name, is_free in
+                          zip(model_copy.param_names, free_params) if is_free]
+        best_values = [getattr(model_copy, name).value
+                       for name in free_par_names]
+
+        # Step sizes from the Hessian of the C-statistic at the best fit, if
+        # the model has derivatives.
+        param_errs = np.full(len(free_par_names), np.nan)
+        if has_derivatives(model_copy):
+            model_vals, model_derivs = get_model_vals_and_derivs(model_copy, x)
+            hess = cstat_hess_from_vals(measured_raw_cts, model_vals,
+                                        model_derivs[free_params],
+                                        measured_bkg_cts, t_raw, t_bkg)
+            try:
+                with np.errstate(invalid='ignore'):
+                    param_errs = np.sqrt(np.diag(2. * np.linalg.inv(hess)))
+            except np.linalg.LinAlgError:
+                pass
+        bad_errs = ~np.isfinite(param_errs) | (param_errs == 0)
+        param_errs[bad_errs] = 0.1 * np.abs(np.array(best_values))[bad_errs]
+        param_errs[param_errs == 0] = 1e-3
+        threshold = chi2.ppf(cl / 100., 1)
+
+        names = [name for name in free_par_names for sign in (-1, 1)]
+        steps = [sign * step * err for err in param_errs for sign in (-1, 1)]
+        init_args = (self._optimizer, model_copy, x, measured_raw_cts,
+                     measured_bkg_cts, t_raw, t_bkg, kwargs)
+        pool = get_pool(n_jobs, backend, initializer=init_profile_worker,
+                        initargs=init_args)
+        scan_args = (names, steps, [max_steps] * len(names),
+                     [threshold] * len(names))
+        if pool is None:
+            init_profile_worker(*init_args)
+            scans = pool_map(None, worker_profile_scan, *scan_args)
+        else:
+            with pool:
+                scans = pool_map(pool, worker_profile_scan, *scan_args)
+
+        fit_data = []
+        self.profile_info = {}
+        for i, name in enumerate(free_par_names):
+            (lower_values, lower_stats, lower), \
+                (upper_values, upper_stats, upper) = scans[2 * i:2 * i + 2]
+            if np.isnan(lower) or np.isnan(upper):
+                warnings.warn("The confidence interval of %s was not found "
+                              "on both sides, within max_steps steps and the "
+                              "bounds of the parameter." % name,
+                              AstropyUserWarning)
+            fit_data.append([name, best_values[i], lower - best_values[i],
+                             upper - best_values[i]])
+            self.profile_info[name] = (
+                np.concatenate([lower_values[:0:-1], upper_values]),
+                np.concatenate([lower_stats[:0:-1], upper_stats]))
+
+        print_fit_summary(fit_data, floatfmt, tablefmt)
         print('\n'*2)
 
         return fit_data
+
+    def batch_fit(self, model, profiles, minrange=0., maxrange=np.inf,
+                  keys=None, use_widths=False, n_jobs=None,
+                  backend='process', **kwargs):
+        """Fit the same model to many profiles.
+
+        `profiles` is a sequence of profiles (`ProfileTable` objects, or the
+        lists of rows returned by older versions), and the bins with radii
+        between `minrange` and `maxrange` are fitted. If `use_widths` is
+        True, then the model is integrated over the widths of the bins (see
+        `__call__`). `kwargs` are passed to the fits.
+
+        The profiles are fitted in order, and each fit starts from the
+        parameters of the nearest profile whose fit has already converged,
+        or from those of `model` if there is none yet. `keys` give the
+        positions of the profiles used to find the nearest one, as a (profile
+        x key) array or one number per profile, e.g. the sector numbers or
+        (cluster, sector, band) indices. By default, the nearest profile is
+        the closest one in the sequence.
+
+        The fits can be run in a pool of `n_jobs` workers (one per CPU if
+        negative), either processes or threads depending on `backend`. By
+        default, they are run serially. In a pool, a fit is started as soon
+        as a worker is free, from the nearest fit that has converged by
+        then, so the starting points can depend on the order in which the
+        fits finish.
+
+        Returns a structured array with one row per profile, and the fields
+        'seed' (the index of the profile that the fit started from, or -1),
+        the fitted parameters, their uncertainties ('err_' followed by the
+        name of the parameter, NaN if the parameter is not fitted), 'cstat',
+        'exit_mode' and 'numiter' as reported by the optimizer,
+        'converged' (True if the exit mode is 0), and 'error' (the message of
+        the numerical error that stopped the fit, or empty). A warning is
+        issued if any fit failed with an error. Other errors, e.g. in the
+        model, are raised.
+        """
+        template = _validate_model(model, self.supported_constraints)
+        if keys is None:
+            keys = np.arange(len(profiles))
+        keys = np.asarray(keys, dtype=float).reshape((len(profiles), -1))
+
+        fit_args = []
+        for profile in profiles:
+            profile = ProfileTable.from_rows(profile).select(minrange,
+                                                             maxrange)
+            x_err = profile['width'] if use_widths else None
+            fit_args.append((profile['radius'], profile['raw_cts'],
+                             profile['bkg_cts'], profile['t_raw'],
+                             profile['t_bkg'], x_err))
+
+        results = [None] * len(profiles)
+        seeds = np.full(len(profiles), -1)
+
+        def get_start_model(i):
+            # Starts from the nearest converged fit, if any.
+            converged = [j for j, result in enumerate(results)
+                         if result is not None and result[3] == 0]
+            start_model = template.copy()
+            if converged:
+                distances = np.sum((keys[converged] - keys[i])**2, axis=1)
+                seeds[i] = converged[np.argmin(distances)]
+                start_model.parameters = results[seeds[i]][0]
+            return start_model
+
+        init_args = (self._optimizer, kwargs)
+        pool = get_pool(n_jobs, backend, initializer=init_batch_worker,
+                        initargs=init_args)
+        if pool is None:
+            init_batch_worker(*init_args)
+            for i in range(len(profiles)):
+                results[i] = worker_batch_fit(get_start_model(i),
+                                              *fit_args[i])
+        else:
+            n_workers = get_n_workers(n_jobs)
+            pending = list(range(len(profiles)))
+            running = {}
+            with pool:
+                while pending or running:
+                    while pending and len(running) < n_workers:
+                        i = pending.pop(0)
+                        running[pool.submit(worker_batch_fit,
+                                            get_start_model(i),
+                                            *fit_args[i])] = i
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results[running.pop(future)] = future.result()
+
+        par_names = template.param_names
+        errors = [result[5] for result in results]
+        dtype = [('seed', np.int64)] + \
+                [(name, np.float64) for name in par_names] + \
+                [('err_' + name, np.float64) for name in par_names] + \
+                [('cstat', np.float64), ('exit_mode', np.int64),
+                 ('numiter', np.int64), ('converged', bool),
+                 ('error', 'U%d' % max([len(error) for error in errors] +
+                                       [1]))]
+        table = np.empty(len(profiles), dtype=dtype)
+        table['seed'] = seeds
+        for i, (params, param_errs, stat, exit_mode, numiter, error) in \
+                enumerate(results):
+            for name, value, err in zip(par_names, params, param_errs):
+                table[i][name] = value
+                table[i]['err_' + name] = err
+            table[i]['cstat'] = stat
+            table[i]['exit_mode'] = exit_mode
+            table[i]['numiter'] = numiter
+            table[i]['error'] = error
+        table['converged'] = table['exit_mode'] == 0
+        n_errors = sum(bool(error) for error in errors)
+        if n_errors > 0:
+            warnings.warn("%d of the %d fits failed with an error, e.g. "
+                          "'%s'; see the 'error' field."
+                          % (n_errors, len(profiles),
+                             next(error for error in errors if error)),
+                          AstropyUserWarning)
+        return table
@@ -1,12 +1,80 @@
 from astropy.io import fits
 import numpy as np
 
-from .box import Box
-from .epanda import Epanda
-from .utils import clean_header
+from .messages import ErrorMessages
+
+# Data types of unscaled FITS images, indexed by BITPIX.
+BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8',
+                 -32: '>f4', -64: '>f8'}
+
+def clean_header(hdr):
+    """Remove unwanted keywords from the image header.
+
+    Deletes from the image header unncessary keywords such as HISTORY and
+    COMMENT, as well as keywords associated with a 3rd and 4th dimension
+    (e.g. NAXIS3, NAXIS4). Some radio images are 4D, but the 3rd and 4th
+    dimensions are not necessary for plotting the brightness and may
+    occasionally cause problems.
+    """
+    forbidden_keywords = {'HISTORY', 'COMMENT', 'NAXIS3', 'NAXIS4',
+        'CTYPE3', 'CTYPE4', 'CRVAL3', 'CRVAL4', 'CDELT3', 'CDELT4',
+        'CRPIX3', 'CRPIX4', 'CUNIT3', 'CUNIT4'}
+    existing_keywords = [key for key in forbidden_keywords if key in hdr]
+    if any(existing_keywords):
+        for key in existing_keywords:
+            del hdr[key]
+    return hdr
+
+def is_raw_image(hdul, ext):
+    """Check whether the data of an image HDU are stored as is in the file.
+
+    This is the case for plain (primary or extension) image HDUs in files
+    that are not compressed (e.g. not .fits.gz), and whose data are not
+    scaled with BSCALE or BZERO. Their data can then be memory-mapped
+    directly from the file.
+    """
+    hdu = hdul[ext]
+    fileinfo = hdul.fileinfo(ext)
+    return isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) and \
+        fileinfo is not None and \
+        getattr(fileinfo['file'], 'compression', None) is None and \
+        hdu.header.get('BSCALE', 1) == 1 and hdu.header.get('BZERO', 0) == 0
+
+def read_image(filename, ext=0, region=None, margin=2, memmap=True):
+    """Read a FITS image and the associated header.
+
+    If a region is given, then only the section of the image that covers
+    the region, plus `margin` pixels on each side, is read. Returns the
+    image data, the header, and the (row, col) coordinates in the full image
+    of the first pixel of the data. The file is closed before returning.
+    """
+    with fits.open(filename, memmap=memmap) as img_hdu:
+        hdu = img_hdu[ext]
+        hdr = clean_header(hdu.header)
+        nrows, ncols = hdu.shape[-2:]
+        if region is not None:
+            x_min_bound, x_max_bound, y_min_bound, y_max_bound = \
+                region.get_bounds()
+            row_min = min(max(y_min_bound - margin, 0), nrows)
+            row_max = min(max(y_max_bound + margin + 1, 0), nrows)
+            col_min = min(max(x_min_bound - margin, 0), ncols)
+            col_max = min(max(x_max_bound + margin + 1, 0), ncols)
+            data = hdu.section[row_min:row_max, col_min:col_max]
+            origin = (row_min, col_min)
+        elif memmap and is_raw_image(img_hdu, ext):
+            # Memory-map the data directly, so that it stays available after
+            # the file is closed and can be shared with worker processes.
+            data = np.memmap(filename, dtype=BITPIX_DTYPES[hdr['BITPIX']],
+                             mode='r', offset=img_hdu.fileinfo(ext)['datLoc'],
+                             shape=hdu.shape)
+            origin = (0, 0)
+        else:
+            data = hdu.data
+            origin = (0, 0)
+    return data, hdr, origin
 
 class Image():
-    def __init__(self, filename, ext=0):
+    def __init__(self, filename, ext=0, region=None, margin=2, memmap=True):
         """Return a FITS image and the associated header.
 
         The image is returned as a numpy array. By default, the first HDU is read.
@@ -14,25 +82,78 @@ class Image():
         image is modified to remove unncessary keywords such as HISTORY and COMMENT,
         as well as keywords associated with a 3rd and 4th dimension (e.g. NAXIS3,
         NAXIS4).
+
+        By default, the image is memory-mapped, so only the pixels that are
+        used are read from disk. If a region is given, then only the section
+        of the image that covers the region (plus `margin` pixels on each
+        side) is read. The (row, col) coordinates of the first pixel of the
+        section in the full image are stored in `origin`, and are used to
+        find the pixels of the region, so that regions are always defined
+        with respect to the full image. The files are closed once the images
+        are read.
         """
         if not isinstance(filename, list):
-            img_hdu = fits.open(filename)
-            self.data = img_hdu[ext].data
-            self.hdr = clean_header(img_hdu[ext].header)
+            self.data, self.hdr, self.origin = read_image(filename, ext,
+                                                          region, margin,
+                                                          memmap)
         else:
             img_hdr = []
             img_data = []
+            img_origin = []
             if ext == 0:
                 ext = [ext] * len(filename)
             elif len(ext) != len(filename):
                 raise IndexError('Length of the extension array must match \
                     number of images.')
             for i in range(len(filename)):
-                img_hdu = fits.open(filename[i])
-                img_data.append(img_hdu[ext[i]].data)
-                img_hdr.append(clean_header(img_hdu[ext[i]].header))
+                data, hdr, origin = read_image(filename[i], ext[i], region,
+                                               margin, memmap)
+                img_data.append(data)
+                img_hdr.append(hdr)
+                img_origin.append(origin)
             self.data = img_data
             self.hdr = img_hdr
+            self.origin = img_origin
+
+class ConstantMap():
+    def __init__(self, value, hdr=None):
+        """Return a map with the same value in every pixel.
+
+        The map behaves like a scalar broadcast to the shape of the counts
+        image, without storing any pixels, and can be used in place of the
+        data of a background or exposure map. If a header is given, then
+        its keywords (e.g. EXPOSURE and BKGNORM for background maps) are
+        used in the same way as those of an image read from a file.
+        """
+        self.value = value
+        self.hdr = hdr
+
+    @classmethod
+    def from_header(cls, hdr, keyword='EXPOSURE'):
+        """Make a map whose value is read from a header keyword.
+
+        E.g., an exposure map that is constant and equal to the exposure
+        time of the observation.
+        """
+        return cls(hdr[keyword], hdr)
+
+    def __getitem__(self, index):
+        rows, cols = index
+        return np.full(np.shape(rows), self.value, dtype=float)
+
+def parse_shape(reg_def):
+    """Get region shape and parameters from a DS9 region definition.
+
+    Splits the region definition (e.g. 'circle(100,100,20)') into a string
+    describing the region shape and a list of floats containing the
+    parameters of the region. Comments following the definition are
+    ignored.
+    """
+    reg_def = reg_def.split('#')[0].strip()
+    shape = reg_def.split(r'(')[0].strip()
+    params = [float(i) for i in
+              reg_def.split(r'(')[1].split(')')[0].split(',')]
+    return (shape, params)
 
 def read_shape(data):
     """Get region shape and parameters.
@@ -41,31 +162,92 @@ def read_shape(data):
     (e.g. box, circle) and a list of floats containing the parameters of the
     region.
     """
-    reg_def = data[3].strip()
-    shape = reg_def.split(r'(')[0]
-    params = [float(i) for i in reg_def.split(r'(')[1].strip(')').split(',')]
-    return (shape, params)
+    return parse_shape(data[3])
 
-def load_region(filename):
-    """Read DS9 region file.
+def read_region_defs(filename, excluded=False):
+    """Read the region definitions in a DS9 region file.
 
-    Reads a DS9 region file in which the region is defined in image coordinates.
-    The region file should contain a single region. Compound regions are not
-    supported currently.
+    Returns a list of (shape, params) tuples, in the order in which the
+    regions are defined. If `excluded` is True, then the excluded regions
+    (those whose shape starts with a minus sign, e.g. '-circle') are
+    returned instead of the included ones, without the minus sign.
+    Comments, global properties, coordinate system definitions, and the
+    field() region are skipped, and several regions can be defined on the
+    same line if they are separated by semicolons. All the regions must
+    be defined in image coordinates.
     """
-    reg_file = open(filename)
+    with open(filename) as reg_file:
+        data = reg_file.readlines()
+    coord_sys = None
+    reg_defs = []
+    for line in data:
+        for reg_def in line.split(';'):
+            reg_def = reg_def.strip()
+            if not reg_def or reg_def.startswith('#') or \
+               reg_def.startswith('global') or reg_def.startswith('field'):
+                continue
+            if '(' not in reg_def:
+                coord_sys = reg_def.split('#')[0].strip()
+                continue
+            if coord_sys != 'image':
+                error_message = ErrorMessages('004')
+                raise ValueError(error_message)
+            if reg_def.startswith('-') == excluded:
+                reg_defs.append(parse_shape(reg_def.lstrip('-')))
+    return reg_defs
+
+def make_region(shape, params):
+    """Make a region object from its DS9 shape and parameters."""
+    # Imported here because the region modules depend on this module.
+    from .box import Box
+    from .epanda import Epanda
+
     regions = {'box': Box.from_params,
                'epanda': Epanda.from_epanda_params,
                'panda': Epanda.from_panda_params,
                'circle': Epanda.from_circle_params,
                'ellipse': Epanda.from_ellipse_params}
-    data = reg_file.readlines()
-    if len(data) != 4 or data[2].strip() != 'image':
+    return regions[shape](params)
+
+def load_regions(filename):
+    """Read all the regions in a DS9 region file.
+
+    Reads a DS9 region file in which the regions are defined in image
+    coordinates, and returns a list with one region object for each
+    box, (elliptical) panda, circle, or ellipse in the file.
+    """
+    return [make_region(shape, params)
+            for shape, params in read_region_defs(filename)]
+
+def load_region(filename, verbose=False):
+    """Read DS9 region file.
+
+    Reads a DS9 region file in which the region is defined in image coordinates.
+    The region file should contain a single region. Compound regions are not
+    supported currently. To read files with several regions, use
+    `load_regions`.
+    """
+    reg_defs = read_region_defs(filename)
+    if len(reg_defs) != 1:
         error_message = ErrorMessages('002')
         raise ValueError(error_message)
-    else:
-        shape, params = read_shape(data)
-        region = regions[shape](params)
+    shape, params = reg_defs[0]
+    region = make_region(shape, params)
+    if verbose:
         print("Region loaded. Its shape and parameters are listed below: ")
         print(shape, params)
-        return region
+    return region
+
+def load_exclusions(filename):
+    """Read the excluded regions in a DS9 region file.
+
+    Reads the regions that are excluded (e.g. '-circle(...)') from a DS9
+    region file in which the regions are defined in image coordinates, such
+    as a list of point sources. The included regions in the file, if any,
+    are ignored. Returns an `Exclusions` object.
+    """
+    # Imported here because the exclusions module depends on this module.
+    from .exclusions import Exclusions
+
+    return Exclusions.from_region_defs(read_region_defs(filename,
+                                                       excluded=True))
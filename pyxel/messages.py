@@ -9,7 +9,12 @@ def ErrorMessages(error_number):
             Enlarge the region or lower the minimum
             count threshold.''',
         '002': '''Currently only region files with one
-            region defined in image coordinates are supported.'''
+            region defined in image coordinates are supported.''',
+        '004': '''Currently only regions defined in image coordinates
+            are supported.''',
+        '005': '''The region extends beyond the section of the image that
+            was read. Read the image with the region that is profiled, or
+            with a larger margin, or read the full image.'''
     }
     return tw.fill(remove_whitespace(errors[error_number]), 80)
 
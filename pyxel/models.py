@@ -1,54 +1,292 @@
-import os
+import copy
+from collections import OrderedDict, namedtuple
 
 import numpy as np
-import scipy.integrate
 from astropy.modeling import Fittable1DModel, Parameter, Model
 
+# Limits and Gauss-Legendre nodes of the line-of-sight integrals of BrokenPow.
+LOS_Z_MIN = 1e-4
+LOS_Z_MAX = 1e4
+LOS_ROOTS, LOS_WEIGHTS = np.polynomial.legendre.leggauss(128)
+
+# Classes made by the model class factories, indexed by the factory and its
+# arguments, so that each class is made only once.
+MODEL_CLASSES = {}
+
+def get_class_spec(cls):
+    """Describe how to make a model class.
+
+    Classes made by a factory such as `IntModel` cannot be pickled by name,
+    so they are described by the factory, the class that the factory
+    wrapped, and the other arguments of the factory. Other classes are
+    returned unchanged.
+    """
+    factory = cls.__dict__.get('_factory')
+    if factory is None:
+        return cls
+    func, model_cls, args = factory
+    return (func, get_class_spec(model_cls), args)
+
+def make_class(spec):
+    """Make the model class described by `get_class_spec`."""
+    if not isinstance(spec, tuple):
+        return spec
+    func, model_cls_spec, args = spec
+    return func(make_class(model_cls_spec), *args)
+
+def unpickle_model(spec):
+    """Make an empty model of a class made by a factory, whose attributes
+    are then restored by pickle."""
+    cls = make_class(spec)
+    return cls.__new__(cls)
+
+def reduce_model(model):
+    """Pickle a model whose class was made by a factory.
+
+    The values cached by `Cached` models are not pickled.
+    """
+    state = model.__dict__.copy()
+    if isinstance(state.get('cache'), ModelCache):
+        state['cache'] = ModelCache(state['cache'].maxsize)
+    return (unpickle_model, (get_class_spec(model.__class__),), state)
+
 def IntModel(model_cls):
+    """Make a model class that averages `model_cls` over bins.
+
+    The classes are made only once for each `model_cls`, and their models
+    can be pickled, e.g. to send them to worker processes.
+    """
+    if (IntModel, model_cls) in MODEL_CLASSES:
+        return MODEL_CLASSES[(IntModel, model_cls)]
+
     class MyIntModel(model_cls):
-        def __init__(self, widths, order=5, *args, **kwargs):
+        _factory = (IntModel, model_cls, ())
+
+        def __init__(self, widths, order=5, *args, max_order=None,
+                     variation=0.1, rtol=1e-6, **kwargs):
+            """Model averaged over bins of half-width `widths`.
+
+            The bins are integrated with Gauss-Legendre quadrature of the
+            given `order`. The abscissae of all the bins form a (bins x
+            nodes) matrix, which is made once for each set of bins, and the
+            underlying model is evaluated over the whole matrix in a single
+            call.
+
+            If `max_order` is given, then the order is raised adaptively:
+            the bins over which the integrand varies by more than
+            `variation` times its average are integrated again with twice
+            the order, which is repeated for the bins whose integrals change
+            by more than `rtol` until `max_order` is reached.
+            """
             self._widths = widths
-            self._roots, self._weights = np.polynomial.legendre.leggauss(order)
+            self._order = order
+            self._max_order = max_order
+            self._variation = variation
+            self._rtol = rtol
+            self._grids = {}
             super(MyIntModel, self).__init__(*args, **kwargs)
 
-        def __getnewargs__(self):
-            return (model_cls,)
+        def __reduce__(self):
+            return reduce_model(self)
 
-        def __getstate__(self):
-            print(os.getpid())
-            return (model_cls, super(MyIntModel, self).__dict__)
+        def get_grid(self, x, order):
+            """Get the abscissae and weights for integrating the bins.
 
-        def __setstate__(self, state):
-            cls, attributes = state
-            obj = cls.__new__(cls)
-            self.__dict__.update(attributes)
-            return obj
-            #print(os.getpid())
-            #print(model_cls, os.getpid())
-            #return None
+            Returns two (bins x nodes) arrays. The weights include the
+            division by the width of the bins, so that the weighted sums are
+            the averages over the bins. The arrays are cached for each order
+            until the bins change.
+            """
+            x = np.asarray(x, dtype=float)
+            widths = np.asarray(self._widths, dtype=float)
+            if order in self._grids:
+                grid_x, grid_widths, abscissae, weights = self._grids[order]
+                if np.array_equal(grid_x, x) and \
+                   np.array_equal(grid_widths, widths):
+                    return abscissae, weights
+            roots, weights = np.polynomial.legendre.leggauss(order)
+            a, b = x - widths, x + widths
+            abscissae = ((b - a) / 2.0)[:, np.newaxis] * roots + \
+                        ((a + b) / 2.0)[:, np.newaxis]
+            weights = ((b - a) / 2.0 / (2.*widths))[:, np.newaxis] * weights
+            self._grids[order] = (x.copy(), widths.copy(), abscissae, weights)
+            return abscissae, weights
 
-        def evaluate_for_integral(self, fn, a, b, *params):
-            return (b - a) / 2.0 * np.array(fn((b - a) / 2.0 * self._roots + (a + b) / 2.0, *params))
+        def integrate(self, fn, x, *params):
+            """Average `fn` over each bin.
 
-        def evaluate(self, x, *params):
-            fn = super(MyIntModel, self).evaluate
+            `fn` is called with the abscissae as a flat array, and may
+            return several values (e.g. one per parameter) for each
+            abscissa. The bins are along the last axis of the result.
+            """
+            def get_samples(order, bins):
+                abscissae, weights = self.get_grid(x, order)
+                abscissae, weights = abscissae[bins], weights[bins]
+                samples = np.array(fn(abscissae.ravel(), *params))
+                samples = samples.reshape(samples.shape[:-1] +
+                                          abscissae.shape)
+                return np.sum(weights * samples, axis=-1), samples
 
-            # Gauss-Legendre integration
-            sample_points = np.array([self.evaluate_for_integral(fn, d - dw, d + dw, *params) / (2.*dw)
-                                      for d, dw in zip(x, self._widths)])
-            result = np.sum(self._weights * sample_points, axis=1)
+            all_bins = slice(None)
+            result, samples = get_samples(self._order, all_bins)
+            if self._max_order is None:
+                return result
+
+            # Bins over which the integrand varies strongly.
+            nbins = result.shape[-1]
+            variation = np.ptp(samples, axis=-1) > \
+                        self._variation * np.abs(result)
+            bins = np.flatnonzero(variation.reshape(-1, nbins).any(axis=0))
+            order = 2 * self._order
+            while len(bins) > 0 and order <= self._max_order:
+                bin_result, _ = get_samples(order, bins)
+                unconverged = np.abs(bin_result - result[..., bins]) > \
+                              self._rtol * np.abs(bin_result)
+                result[..., bins] = bin_result
+                bins = bins[unconverged.reshape(-1, len(bins)).any(axis=0)]
+                order *= 2
             return result
 
-        def fit_deriv(self, x, *params):
-            fn = super(MyIntModel, self).fit_deriv
+        def evaluate(self, x, *params):
+            # Gauss-Legendre integration
+            return self.integrate(super(MyIntModel, self).evaluate, x,
+                                  *params)
 
-            sample_points = np.array([self.evaluate_for_integral(fn, d - dw, d + dw, *params) / (2.*dw)
-                                      for d, dw in zip(x, self._widths)])
-            result = np.sum(self._weights * sample_points, axis=2).T
-            return result
+        # The derivatives are only defined if the underlying model has them,
+        # so that models without derivatives are still recognized as such.
+        if model_cls.fit_deriv is not None:
+            def fit_deriv(self, x, *params):
+                return self.integrate(super(MyIntModel, self).fit_deriv, x,
+                                      *params)
+
+        if hasattr(model_cls, 'evaluate_with_derivatives'):
+            def evaluate_with_derivatives(self, x, *params):
+                """Evaluate the integrated model and its derivatives together.
+
+                The values and the derivatives are integrated from the same
+                evaluations of the underlying model.
+                """
+                fn = super(MyIntModel, self).evaluate_with_derivatives
+
+                def stacked_fn(x, *params):
+                    vals, derivs = fn(x, *params)
+                    return np.vstack([np.broadcast_to(vals, np.shape(x)),
+                                      np.array(derivs)])
+
+                result = self.integrate(stacked_fn, x, *params)
+                return result[0], result[1:]
 
+    MODEL_CLASSES[(IntModel, model_cls)] = MyIntModel
     return MyIntModel
 
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class ModelCache(object):
+    """Bounded least-recently-used cache of model evaluations.
+
+    The number of lookups that were found in the cache (hits) and that
+    had to be computed (misses) are counted, and are reported by
+    `cache_info` in the same form as for `functools.lru_cache`.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(name, *arrays):
+        """Make a cache key from a method name and the exact values of its
+        arguments."""
+        key = [name]
+        for array in arrays:
+            array = np.ascontiguousarray(array, dtype=float)
+            key.append((array.shape, array.tobytes()))
+        return tuple(key)
+
+    def lookup(self, key, compute):
+        """Get the value cached for `key`, or compute it with `compute()`
+        and cache it. Copies of the cached values are returned, so that
+        they can be modified freely."""
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return copy.deepcopy(self._entries[key])
+        self.misses += 1
+        value = compute()
+        if self.maxsize is None or self.maxsize > 0:
+            self._entries[key] = copy.deepcopy(value)
+            if self.maxsize is not None and len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._entries))
+
+    def clear(self):
+        """Empty the cache and reset the counters."""
+        self.hits = 0
+        self.misses = 0
+        self._entries.clear()
+
+def Cached(model_cls, maxsize=128):
+    """Make a model class whose evaluations are cached.
+
+    The values returned by `evaluate`, `fit_deriv`, and (if the model has
+    it) `evaluate_with_derivatives` are kept in a `ModelCache` of at most
+    `maxsize` entries (unbounded if None), keyed on the exact values of x,
+    of the parameters, and, for models made with `IntModel`, of the bin
+    widths. This pays off for expensive models, such as integrated or
+    broken power-law models, when the same parameters are evaluated several
+    times, e.g. by Nelder-Mead or by MCMC. The cache of a model is its
+    `cache` attribute, e.g. `model.cache.cache_info()`. Fitters copy the
+    models that they fit, so the cache of the fitted model, not of the
+    initial model, counts the evaluations of a fit.
+
+    As for `IntModel`, the classes are made only once for each `model_cls`
+    and `maxsize`, and their models can be pickled. The cached values are
+    not pickled.
+    """
+    if (Cached, model_cls, maxsize) in MODEL_CLASSES:
+        return MODEL_CLASSES[(Cached, model_cls, maxsize)]
+
+    class MyCachedModel(model_cls):
+        _factory = (Cached, model_cls, (maxsize,))
+
+        def __init__(self, *args, **kwargs):
+            self.cache = ModelCache(maxsize)
+            super(MyCachedModel, self).__init__(*args, **kwargs)
+
+        def __reduce__(self):
+            return reduce_model(self)
+
+        def cached_call(self, name, fn, x, *params):
+            key = ModelCache.make_key(name, x, getattr(self, '_widths', ()),
+                                      *params)
+            return self.cache.lookup(key, lambda: fn(x, *params))
+
+        def evaluate(self, x, *params):
+            return self.cached_call('evaluate',
+                                    super(MyCachedModel, self).evaluate,
+                                    x, *params)
+
+        if model_cls.fit_deriv is not None:
+            def fit_deriv(self, x, *params):
+                return self.cached_call('fit_deriv',
+                                        super(MyCachedModel, self).fit_deriv,
+                                        x, *params)
+
+        if hasattr(model_cls, 'evaluate_with_derivatives'):
+            def evaluate_with_derivatives(self, x, *params):
+                return self.cached_call(
+                    'evaluate_with_derivatives',
+                    super(MyCachedModel, self).evaluate_with_derivatives,
+                    x, *params)
+
+    MODEL_CLASSES[(Cached, model_cls, maxsize)] = MyCachedModel
+    return MyCachedModel
+
 class Beta(Fittable1DModel):
     s0 = Parameter(default = 1e-2, min = 1e-12)
     beta = Parameter(default = 0.7, min = 1e-12)
@@ -69,7 +307,49 @@ class Beta(Fittable1DModel):
                * (1. + (x/rc)**2) ** (-0.5 - 3*beta)
         return [d_s0, d_beta, d_rc, np.ones_like(x)]
 
+    @staticmethod
+    def evaluate_with_derivatives(x, s0, beta, rc, const):
+        """Evaluate the model and its derivatives with respect to the
+        parameters, sharing the common terms."""
+        tmp = 1. + (x/rc)**2
+        d_s0 = tmp ** (0.5 - 3*beta)
+        result = s0 * d_s0 + const
+        d_beta = -3 * s0 * np.log(tmp) * d_s0
+        d_rc = -2 * s0 * x**2 * (0.5 - 3*beta) / rc**3 \
+               * tmp ** (-0.5 - 3*beta)
+        return result, [d_s0, d_beta, d_rc, np.ones_like(x)]
+
+def los_integrals(x, rbreak, ind, z_min, z_max):
+    """Integrate a power law along the line of sight.
+
+    Returns the integrals of ((x**2 + z**2) / rbreak**2)**(-ind), and of the
+    same function times log((x**2 + z**2) / rbreak**2), over z from `z_min`
+    to `z_max`, for each of the projected radii `x`. The integrals are
+    evaluated for all the radii at once with a fixed Gauss-Legendre
+    quadrature in log(z), over which the integrands are smooth. The radii
+    and the parameters are broadcast against each other, e.g. to integrate
+    for several sets of parameters at once.
+    """
+    rbreak = np.asarray(rbreak)[..., np.newaxis]
+    ind = np.asarray(ind)[..., np.newaxis]
+    log_min, log_max = np.log(z_min), np.log(z_max)
+    half_range = ((log_max - log_min) / 2.)[..., np.newaxis]
+    z = np.exp(half_range * LOS_ROOTS + ((log_max + log_min) / 2.)[...,
+                                                                 np.newaxis])
+    weights = half_range * LOS_WEIGHTS * z
+    log_base = np.log((x[..., np.newaxis]**2 + z**2) / rbreak**2)
+    fz = weights * np.exp(-ind * log_base)
+    return np.sum(fz, axis=-1), np.sum(fz * log_base, axis=-1)
+
 class BrokenPow(Fittable1DModel):
+    """Projection of a broken power-law density, e.g. for shocks and cold
+    fronts.
+
+    The line-of-sight integrals (from z = 1e-4 to 1e4) are evaluated for all
+    the radii at once with a fixed quadrature (see `los_integrals`). The
+    values and derivatives agree with carefully subdivided adaptive
+    quadrature to a relative accuracy of about 1e-12.
+    """
     ind1 = Parameter(default = 0.)
     ind2 = Parameter(default = 0.)
     norm = Parameter(default = 1e-2, min = 1e-12)
@@ -77,98 +357,53 @@ class BrokenPow(Fittable1DModel):
     jump = Parameter(default = 2.0, min = 1., max = 4.)
     const = Parameter(default = 1e-3)
 
-    """
-    @staticmethod
-    def evaluate_with_derivatives(...):
-        ...
-    """
-
     @staticmethod
     def evaluate(x, ind1, ind2, norm, rbreak, jump, const):
-        if not isinstance(x, (int, float)):
-            sx = np.zeros_like(x)
-            for i in range(len(sx)):
-                sx[i] = BrokenPow.evaluate_one(x[i], ind1, ind2, norm, rbreak, jump)
-        else:
-            sx = BrokenPow.evaluate_one(x, ind1, ind2, norm, rbreak, jump)
-        return sx+const
-
-    @staticmethod
-    def evaluate_one(xval, ind1, ind2, norm, rbreak, jump):
-        norm_after_jump = norm / jump**2
-        if xval <= rbreak:
-            return norm * scipy.integrate.quad(lambda z:
-                               ((xval**2 + z**2) / rbreak**2)**(-ind1),
-                               1e-4, np.sqrt(rbreak**2 - xval**2))[0] + \
-                    norm_after_jump * scipy.integrate.quad(lambda z:
-                               ((xval**2 + z**2) / rbreak**2)**(-ind2),
-                               np.sqrt(rbreak**2 - xval**2), 1e4)[0]
-        else:
-            return norm_after_jump * scipy.integrate.quad(lambda z:
-                               ((xval**2 + z**2) / rbreak**2)**(-ind2),
-                                1e-4, 1e4)[0]
+        return BrokenPow.evaluate_with_derivatives(x, ind1, ind2, norm,
+                                                   rbreak, jump, const)[0]
 
     @staticmethod
     def fit_deriv(x, ind1, ind2, norm, rbreak, jump, const):
-        if not isinstance(x, (int, float)):
-            d_ind1 = np.zeros_like(x)
-            d_ind2 = np.zeros_like(x)
-            d_norm = np.zeros_like(x)
-            d_rbreak = np.zeros_like(x)
-            d_jump = np.zeros_like(x)
-            for i in range(len(x)):
-                d_ind1_tmp, d_ind2_tmp, d_norm_tmp, \
-                    d_rbreak_tmp, d_jump_tmp = BrokenPow.fit_deriv_one(
-                    x[i], ind1, ind2, norm, rbreak, jump)
-                d_ind1[i] = d_ind1_tmp
-                d_ind2[i] = d_ind2_tmp
-                d_norm[i] = d_norm_tmp
-                d_rbreak[i] = d_rbreak_tmp
-                d_jump[i] = d_jump_tmp
-        else:
-            d_ind1, d_ind2, d_norm, d_rbreak, d_jump = \
-                BrokenPow.fit_deriv_one(x, ind1, ind2, norm, rbreak, jump)
-        d_const = np.ones_like(x)
-        return [d_ind1, d_ind2, d_norm, d_rbreak, d_jump, d_const]
+        return BrokenPow.evaluate_with_derivatives(x, ind1, ind2, norm,
+                                                   rbreak, jump, const)[1]
 
     @staticmethod
-    def fit_deriv_one(xval, ind1, ind2, norm, rbreak, jump):
-        fn1 = lambda z: ((xval**2 + z**2) / rbreak**2)**(-ind1)
-        fn2 = lambda z: ((xval**2 + z**2) / rbreak**2)**(-ind2)
+    def evaluate_with_derivatives(x, ind1, ind2, norm, rbreak, jump, const):
+        """Evaluate the model and its derivatives with respect to the
+        parameters, reusing the integrals of the model in the derivatives."""
+        x = np.asarray(x, dtype=float)
         norm_after_jump = norm / jump**2
-        if xval <= rbreak:
-            lim = (rbreak**2 - xval**2)**0.5
-            tmp1 = scipy.integrate.quad(fn1, 1e-4, lim)[0]
-            tmp2 = scipy.integrate.quad(fn2, lim, 1e4)[0]
-            d_ind1 = -norm * scipy.integrate.quad(lambda z: fn1(z) *
-                         np.log((xval**2 + z**2)/rbreak**2), 1e-4, lim)[0]
-
-            d_ind2 = -norm_after_jump * scipy.integrate.quad(lambda z: fn2(z) *
-                         np.log((xval**2 + z**2)/rbreak**2), lim, 1e4)[0]
-
-            d_norm = tmp1 + 1./jump**2 * tmp2
-
-            # This is only kind of correct. The derivative of the function
-            # with respect to rbreak is not continuous, so the Leibniz rule
-            # doesn't apply. But in principle this is should work okay as long
-            # as xval != rbreak (which is very unlikely in general).
-            d_rbreak = norm * (2. * ind1/rbreak * tmp1 + rbreak / lim) + \
-                       norm_after_jump * \
-                              (2. * ind2/rbreak * tmp2 - rbreak / lim)
-
-            d_jump = -2 * norm / jump**3 * tmp2
-
-        else:
-            tmp = scipy.integrate.quad(fn2, 1e-4, 1e4)[0]
-            d_ind1 = np.zeros_like(xval)
 
-            d_ind2 = -norm_after_jump * scipy.integrate.quad(lambda z: fn2(z) *
-                         np.log((xval**2 + z**2)/rbreak**2), 1e-4, 1e4)[0]
+        # Within the break, the line of sight crosses the break at z = lim.
+        inside = x <= rbreak
+        lim = np.sqrt(np.maximum(rbreak**2 - x**2, 0.))
+        # Keep the limits positive for the integration in log(z).
+        lim_positive = np.maximum(lim, LOS_Z_MIN * 1e-8)
+        z_min = np.full_like(x, LOS_Z_MIN)
+        z_max = np.full_like(x, LOS_Z_MAX)
 
-            d_norm = 1/jump**2 * tmp
+        tmp1, log_tmp1 = los_integrals(x, rbreak, ind1, z_min, lim_positive)
+        tmp1 = np.where(inside, tmp1, 0.)
+        log_tmp1 = np.where(inside, log_tmp1, 0.)
+        tmp2, log_tmp2 = los_integrals(x, rbreak, ind2,
+                                       np.where(inside, lim_positive, z_min),
+                                       z_max)
 
-            d_rbreak = 2. * norm_after_jump * ind2/rbreak * tmp
+        sx = norm * tmp1 + norm_after_jump * tmp2
+        d_ind1 = -norm * log_tmp1
+        d_ind2 = -norm_after_jump * log_tmp2
+        d_norm = tmp1 + 1./jump**2 * tmp2
 
-            d_jump = -2*norm / jump**3 * tmp
+        # This is only kind of correct. The derivative of the function
+        # with respect to rbreak is not continuous, so the Leibniz rule
+        # doesn't apply. But in principle this is should work okay as long
+        # as xval != rbreak (which is very unlikely in general).
+        with np.errstate(divide='ignore'):
+            d_rbreak = 2. / rbreak * (norm * ind1 * tmp1 +
+                                      norm_after_jump * ind2 * tmp2) + \
+                       np.where(inside,
+                                (norm - norm_after_jump) * rbreak / lim, 0.)
 
-        return [d_ind1, d_ind2, d_norm, d_rbreak, d_jump]
+        d_jump = -2 * norm / jump**3 * tmp2
+        d_const = np.ones(np.shape(sx))
+        return sx+const, [d_ind1, d_ind2, d_norm, d_rbreak, d_jump, d_const]
@@ -1,25 +1,118 @@
+import copy
 import warnings
+from concurrent.futures import FIRST_COMPLETED, wait
 
 import numpy as np
 from astropy.modeling.optimizers import Optimization
 from astropy.utils.exceptions import AstropyUserWarning
 
+from .parallel import get_n_workers, get_pool
+
 DEFAULT_BOUNDS = (-1e12, 1e12)
 
+# Methods of `scipy.optimize.minimize` that use the gradient (jac).
+GRADIENT_METHODS = ('cg', 'bfgs', 'newton-cg', 'l-bfgs-b', 'tnc', 'slsqp',
+                    'dogleg', 'trust-ncg', 'trust-krylov', 'trust-exact',
+                    'trust-constr')
+
+# Methods of `scipy.optimize.minimize` that use the Hessian (hess).
+HESSIAN_METHODS = ('newton-cg', 'dogleg', 'trust-ncg', 'trust-krylov',
+                   'trust-exact', 'trust-constr')
+
+# Options of the methods of `scipy.optimize.minimize`, among those that are
+# set by `Minimize`. Other options are not passed to the methods, since they
+# would warn about them.
+SOLVER_OPTIONS = {'nelder-mead': ('maxiter',), 'powell': ('maxiter', 'ftol'),
+                  'cg': ('maxiter', 'eps'), 'bfgs': ('maxiter', 'eps'),
+                  'newton-cg': ('maxiter', 'eps'),
+                  'l-bfgs-b': ('maxiter', 'eps', 'ftol'),
+                  'tnc': ('maxiter', 'eps', 'ftol'), 'cobyla': ('maxiter',),
+                  'slsqp': ('maxiter', 'eps', 'ftol'),
+                  'dogleg': ('maxiter',), 'trust-ncg': ('maxiter',),
+                  'trust-krylov': ('maxiter',), 'trust-exact': ('maxiter',),
+                  'trust-constr': ('maxiter',)}
+
+# Methods of `scipy.optimize.minimize` that support bounds.
+BOUNDS_METHODS = ('l-bfgs-b', 'tnc', 'slsqp')
+
+def latin_hypercube(n, lower, upper, random_state):
+    """Draw `n` points in a box with a Latin hypercube design.
+
+    Each dimension is divided into `n` equal intervals, and each interval
+    holds exactly one point. Returns an (n x dimension) array.
+    """
+    ndim = len(lower)
+    strata = np.array([random_state.permutation(n) for i in range(ndim)]).T
+    u = (strata + random_state.uniform(size=(n, ndim))) / n
+    return lower + u * (np.asarray(upper) - np.asarray(lower))
+
+class BasinReached(Exception):
+    """Raised to stop a start that has reached the basin of a known
+    minimum."""
+
+def run_start(opt_method, objfunc, x0, kwargs, known_minima, basin_rtol):
+    """Run the minimizer from one starting point.
+
+    The arguments of the objective function are copied, so that the starts
+    that are run in threads do not share the model. The start is stopped
+    as soon as an iterate is within `basin_rtol` (relative) of one of the
+    `known_minima`. Returns the statistics of the start as a dictionary.
+    """
+    kwargs = dict(kwargs, args=copy.deepcopy(kwargs['args']))
+
+    def callback(xk, *args):
+        for x_min in known_minima:
+            if np.all(np.abs(xk - x_min) <= basin_rtol * np.abs(x_min)):
+                raise BasinReached(np.array(xk))
+
+    try:
+        result = opt_method(objfunc, x0, callback=callback, **kwargs)
+    except BasinReached as stop:
+        return {'x0': x0, 'x': stop.args[0], 'fun': np.nan, 'nit': None,
+                'nfev': None, 'status': None, 'message': 'Stopped in the '
+                'basin of a known minimum.', 'stopped_early': True}
+    return {'x0': x0, 'x': result['x'], 'fun': result['fun'],
+            'nit': result.get('nit'), 'nfev': result.get('nfev'),
+            'status': result['status'], 'message': result['message'],
+            'stopped_early': False}
+
 class Minimize(Optimization):
     """General optimization algorithm based on `scipy.optimize.minimize`.
 
     The `Minimize` optimizer allows the use of `scipy.optimize.minimize` and
     the associated optimizer methods with `astropy.modeling`.
+
+    By default (`method=None`), the method is chosen when the optimizer is
+    called: L-BFGS-B if the gradient of the objective function (jac) is
+    given, as it is by `CstatFitter` for models with derivatives, and
+    Nelder-Mead otherwise. The
+    gradient and the Hessian are only passed to the methods that use them.
+
+    If `n_starts` is larger than 1, then the minimizer is run from several
+    starting points: the initial guess, and `n_starts - 1` points drawn
+    with a Latin hypercube design. For the parameters that have both
+    bounds, the points are drawn between the bounds; for the others, they
+    are drawn within `start_scale` times the absolute initial value on
+    either side of it (and within the bound, if there is one). A start is
+    stopped early once an iterate is within `basin_rtol` (relative) of a
+    minimum found by a start that has already finished. The best solution
+    is returned, and the statistics of all the starts are stored in
+    `fit_info['starts']`. The starts can be run in a pool of `n_jobs`
+    workers (one per CPU if negative), either processes or threads
+    depending on `backend`; by default, they are run one after the other.
+    `seed` seeds the random starting points.
     """
     supported_constraints = ['bounds', 'eqcons', 'ineqcons', 'fixed', 'tied']
 
-    def __init__(self, method='Nelder-Mead'):
+    def __init__(self, method=None, n_starts=1, n_jobs=None,
+                 backend='process', seed=None, start_scale=0.5,
+                 basin_rtol=1e-2):
         from scipy.optimize import minimize
         super(Minimize, self).__init__(minimize)
-        method = method.lower()
+        if method is not None:
+            method = method.lower()
         self.supported_constraints = ['fixed', 'tied']
-        if method in ['l-bfgs-b', 'tnc']:
+        if method in [None, 'l-bfgs-b', 'tnc']:
             self.supported_constraints.append('bounds')
         elif method == 'cobyla':
             self.supported_constraints.extend(['eqcons', 'ineqcons'])
@@ -32,6 +125,87 @@ class Minimize(Optimization):
             'num_function_calls': None
         }
         self.method = method
+        self.n_starts = n_starts
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.seed = seed
+        self.start_scale = start_scale
+        self.basin_rtol = basin_rtol
+
+    @property
+    def uses_jac(self):
+        """Whether the optimizer method uses the gradient of the objective
+        function. If the method is chosen automatically, then this depends
+        on whether the gradient is given, see `get_method`."""
+        return self.method in GRADIENT_METHODS
+
+    @property
+    def uses_hess(self):
+        """Whether the optimizer method uses the Hessian of the objective
+        function."""
+        return self.method in HESSIAN_METHODS
+
+    def get_method(self, jac=None):
+        """Get the method to use, given the gradient of the objective
+        function, if any."""
+        if self.method is not None:
+            return self.method
+        return 'l-bfgs-b' if jac is not None else 'nelder-mead'
+
+    def get_starts(self, initval, bounds):
+        """Get the starting points: the initial guess, followed by
+        `n_starts - 1` points drawn with a Latin hypercube design."""
+        initval = np.asarray(initval, dtype=float)
+        bounds = np.array([[np.nan if b is None else b for b in bound]
+                           for bound in bounds], dtype=float)
+        bounds = bounds.reshape((len(initval), 2))
+        width = self.start_scale * np.abs(initval)
+        width[width == 0] = self.start_scale
+        lower = np.where(np.isnan(bounds[:, 0]), initval - width,
+                         np.fmax(bounds[:, 0], initval - width))
+        upper = np.where(np.isnan(bounds[:, 1]), initval + width,
+                         np.fmin(bounds[:, 1], initval + width))
+        has_bounds = ~np.isnan(bounds).any(axis=1)
+        lower[has_bounds] = bounds[has_bounds, 0]
+        upper[has_bounds] = bounds[has_bounds, 1]
+        random_state = np.random.RandomState(self.seed)
+        starts = latin_hypercube(self.n_starts - 1, lower, upper,
+                                 random_state)
+        return np.vstack([initval[np.newaxis], starts])
+
+    def run_starts(self, objfunc, starts, kwargs):
+        """Run the minimizer from each starting point, see `run_start`."""
+        results = [None] * len(starts)
+
+        def get_known_minima():
+            return [result['x'] for result in results
+                    if result is not None and not result['stopped_early']
+                    and result['status'] == 0]
+
+        pool = get_pool(self.n_jobs, self.backend)
+        if pool is None:
+            for i, x0 in enumerate(starts):
+                results[i] = run_start(self.opt_method, objfunc, x0, kwargs,
+                                       get_known_minima(), self.basin_rtol)
+            return results
+
+        # Each start is submitted when a worker is free, with the minima
+        # found so far.
+        n_workers = get_n_workers(self.n_jobs)
+        pending = list(range(len(starts)))
+        running = {}
+        with pool:
+            while pending or running:
+                while pending and len(running) < n_workers:
+                    i = pending.pop(0)
+                    running[pool.submit(run_start, self.opt_method, objfunc,
+                                        starts[i], kwargs,
+                                        get_known_minima(),
+                                        self.basin_rtol)] = i
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        return results
 
     def __call__(self, objfunc, initval, fargs, **kwargs):
         """
@@ -49,11 +223,16 @@ class Minimize(Optimization):
             other keyword arguments to be passed to the solver
 
         """
-        kwargs['options'] = {'maxiter': kwargs.pop('maxiter', self._maxiter),
-                             'eps': kwargs.pop('eps', self._eps),
-                             'ftol': 1e-8,
-                             'factr': 1e4,
-                             'eps': 1e-8}
+        method = self.get_method(kwargs.get('jac'))
+        options = {'maxiter': kwargs.pop('maxiter', self._maxiter),
+                   'eps': kwargs.pop('eps', self._eps),
+                   'ftol': 1e-8,
+                   'factr': 1e4,
+                   'eps': 1e-8}
+        if method in SOLVER_OPTIONS:
+            options = {name: value for name, value in options.items()
+                       if name in SOLVER_OPTIONS[method]}
+        kwargs['options'] = options
 
         acc = self._acc
         try:
@@ -70,17 +249,23 @@ class Minimize(Optimization):
         model = fargs[0]
         pars = [getattr(model, name) for name in model.param_names]
 
-        if 'bounds' in self.supported_constraints:
-            bounds = [par.bounds for par in pars if par.fixed is not True and
-                      par.tied is False]
-            bounds = np.asarray(bounds)
+        if method not in GRADIENT_METHODS:
+            kwargs.pop('jac', None)
+        if method not in HESSIAN_METHODS:
+            kwargs.pop('hess', None)
+
+        free_bounds = [par.bounds for par in pars if par.fixed is not True
+                       and par.tied is False]
+        if 'bounds' in self.supported_constraints and \
+           method in BOUNDS_METHODS:
+            bounds = np.asarray(free_bounds)
             for i in bounds:
                 if i[0] is None:
                     i[0] =  DEFAULT_BOUNDS[0]
                 if i[1] is None:
                     i[1] = DEFAULT_BOUNDS[1]
             # older versions of scipy require this array to be float
-            kwargs['bounds'] = np.asarray(bounds, dtype=np.float)
+            kwargs['bounds'] = np.asarray(bounds, dtype=float)
 
         kwargs['constraints'] = ()
         if 'eqcons' in self.supported_constraints:
@@ -93,8 +278,18 @@ class Minimize(Optimization):
                 for ineq in model.ineqcons:
                     kwargs['constraints'] += ({'type': 'ineq', 'fun': ineq})
 
-        result = self.opt_method(objfunc, initval, method=self.method,
-                                 args=fargs, tol=acc, **kwargs)
+        kwargs.update(method=method, args=fargs, tol=acc)
+        if self.n_starts > 1:
+            starts = self.get_starts(initval, free_bounds)
+            stats = self.run_starts(objfunc, starts, kwargs)
+            finished = [i for i, start_stats in enumerate(stats)
+                        if not start_stats['stopped_early']]
+            best = min(finished, key=lambda i: stats[i]['fun'])
+            result = stats[best]
+            self.fit_info['starts'] = stats
+            self.fit_info['best_start'] = best
+        else:
+            result = self.opt_method(objfunc, initval, **kwargs)
 
         self.fit_info['final_func_val'] = result['fun']
         self.fit_info['numiter'] = result['nit']
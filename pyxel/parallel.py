@@ -0,0 +1,146 @@
+import os
+import tempfile
+import multiprocessing.pool
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+def get_n_workers(n_jobs):
+    """Get the number of workers for `n_jobs` (see `get_pool`)."""
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return os.cpu_count()
+    return n_jobs
+
+def get_pool(n_jobs=None, backend='process', initializer=None, initargs=()):
+    """Create a pool of workers.
+
+    `backend` can be either 'process' or 'thread'. If `n_jobs` is None or 1,
+    then no pool is created and the computations are done serially. If
+    `n_jobs` is negative, then one worker is started for each CPU. If an
+    `initializer` is given, then each worker calls `initializer(*initargs)`
+    once when it starts, e.g. to store data that is used by all its tasks.
+    """
+    n_jobs = get_n_workers(n_jobs)
+    if n_jobs == 1:
+        return None
+    if backend == 'process':
+        return ProcessPoolExecutor(n_jobs, initializer=initializer,
+                                   initargs=initargs)
+    elif backend == 'thread':
+        return ThreadPoolExecutor(n_jobs, initializer=initializer,
+                                  initargs=initargs)
+    else:
+        raise ValueError("Unrecognized backend '%s'. The backend should be \
+            either 'process' or 'thread'." % backend)
+
+def is_process_pool(pool):
+    """Check whether the workers of a pool run in separate processes."""
+    if isinstance(pool, multiprocessing.pool.ThreadPool):
+        return False
+    return isinstance(pool, (ProcessPoolExecutor, multiprocessing.pool.Pool))
+
+def pool_map(pool, func, *iterables):
+    """Map a function over iterables, in a pool if one is given.
+
+    The pool can be a `concurrent.futures` executor, a `multiprocessing`
+    pool, or None, in which case the function is mapped serially. The
+    results are returned as a list, in the order of the inputs.
+    """
+    if pool is None:
+        return list(map(func, *iterables))
+    if isinstance(pool, multiprocessing.pool.Pool):
+        return pool.starmap(func, zip(*iterables))
+    return list(pool.map(func, *iterables))
+
+def get_memmap(array):
+    """Get the memory-mapped array that holds the data of an array, if any."""
+    while array is not None and not isinstance(array, np.memmap):
+        array = getattr(array, 'base', None)
+    if array is None or getattr(array, 'filename', None) is None:
+        return None
+    return array
+
+class SharedArray(object):
+    """Array that can be sent to worker processes without copying its data.
+
+    Arrays that are memory-mapped from a file (such as FITS images opened
+    with memmap=True) are shared through that file. Other arrays are
+    written once to a temporary file. Only the name of the file and the
+    layout of the array are pickled when the array is sent to a worker,
+    and the worker maps the file into memory read-only.
+    """
+    def __init__(self, array):
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self._tmp_filename = None
+        memmap = get_memmap(array)
+        if memmap is not None and array.flags.c_contiguous:
+            self.filename = memmap.filename
+            self.offset = memmap.offset + \
+                          (array.ctypes.data - memmap.ctypes.data)
+        else:
+            fd, self.filename = tempfile.mkstemp(prefix='pyxel_',
+                                                 suffix='.dat')
+            os.close(fd)
+            self._tmp_filename = self.filename
+            np.ascontiguousarray(array).tofile(self.filename)
+            self.offset = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Only the process that created the temporary file removes it.
+        state['_tmp_filename'] = None
+        return state
+
+    def get(self):
+        """Get a read-only view of the array."""
+        if np.prod(self.shape) == 0:
+            return np.empty(self.shape, dtype=self.dtype)
+        return np.memmap(self.filename, dtype=self.dtype, mode='r',
+                         offset=self.offset, shape=self.shape)
+
+    def close(self):
+        """Remove the temporary file that holds the array, if any."""
+        if self._tmp_filename is not None:
+            os.remove(self._tmp_filename)
+            self._tmp_filename = None
+
+class SharedArrays(object):
+    """Collection of arrays shared with worker processes.
+
+    Each distinct array is shared only once, however many times it is
+    passed to `share`. The temporary files are removed when the collection
+    is closed, which is done automatically when it is used as a context
+    manager.
+    """
+    def __init__(self):
+        self._shared = {}
+
+    def share(self, obj):
+        """Wrap an array in `SharedArray`; other objects are returned
+        unchanged."""
+        if not isinstance(obj, np.ndarray):
+            return obj
+        if id(obj) not in self._shared:
+            self._shared[id(obj)] = (obj, SharedArray(obj))
+        return self._shared[id(obj)][1]
+
+    def close(self):
+        for _, shared_array in self._shared.values():
+            shared_array.close()
+        self._shared = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def unshare(obj):
+    """Get the array held by a `SharedArray`; other objects are returned
+    unchanged."""
+    if isinstance(obj, SharedArray):
+        return obj.get()
+    return obj
@@ -1,107 +1,386 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
-from .utils import rotate_point, bin_pix2arcmin, get_bkg_exp
+from .utils import (rotate_point, bin_pix2arcmin, get_bkg_exp,
+                    merge_net_counts)
+from .load_data import Image, ConstantMap
 from .messages import ErrorMessages
-from .load_data import Image
+from .table import ProfileTable
+from .parallel import is_process_pool, pool_map, SharedArrays, unshare
+
+class PixelBins(object):
+    """Pixels of a region grouped into bins.
+
+    The coordinates of the pixels are stored as flat int32 arrays of rows
+    and columns, sorted by bin. The pixels in bin `i` are found at
+    positions `offsets[i]:offsets[i+1]` of these arrays, and the bin spans
+    the radii `edges[i]` to `edges[i+1]`.
+    """
+    def __init__(self, rows, cols, offsets, edges):
+        self.rows = rows
+        self.cols = cols
+        self.offsets = offsets
+        self.edges = list(edges)
+
+    @classmethod
+    def from_labels(cls, rows, cols, labels, edges):
+        """Group pixels by their bin labels.
+
+        The order of the pixels within a bin is preserved.
+        """
+        nbins = len(edges) - 1
+        labels = np.asarray(labels, dtype=np.intp)
+        order = np.argsort(labels, kind='stable')
+        offsets = np.zeros(nbins + 1, dtype=np.intp)
+        np.cumsum(np.bincount(labels, minlength=nbins), out=offsets[1:])
+        return cls(np.asarray(rows, dtype=np.int32)[order],
+                   np.asarray(cols, dtype=np.int32)[order],
+                   offsets, edges)
+
+    @property
+    def nbins(self):
+        return len(self.offsets) - 1
+
+    @property
+    def labels(self):
+        """Bin label of each pixel."""
+        return np.repeat(np.arange(self.nbins, dtype=np.int32),
+                         np.diff(self.offsets))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_pixels(self, start_bin, end_bin):
+        """Get the rows and columns of the pixels in bins
+        `start_bin` to `end_bin - 1`."""
+        start, end = self.offsets[start_bin], self.offsets[end_bin]
+        return self.rows[start:end], self.cols[start:end]
+
+    def get_bin(self, i):
+        """Get the rows and columns of the pixels in bin `i`."""
+        return self.get_pixels(i, i + 1)
+
+    def merge(self, edge_indices):
+        """Merge adjacent bins.
+
+        `edge_indices` are the indices of the edges that are kept. The pixel
+        arrays are shared with the merged bins, not copied.
+        """
+        return PixelBins(self.rows, self.cols, self.offsets[edge_indices],
+                         [self.edges[i] for i in edge_indices])
 
-class Region(object):
+    def label_map(self):
+        """Make a label image of the binned pixels.
 
-    def get_bin_vals(self, counts_img, bkg_img,
-        exp_img, pixels_in_bin, only_net_cts=False):
-        """Calculate the number of counts in a bin."""
-
-        if not isinstance(counts_img.data, list):
-            bkg_corr = [None]
-            counts_img_data, counts_img_hdr = [], []
-            counts_img_data.append(counts_img.data)
-            counts_img_hdr.append(counts_img.hdr)
-
-            bkg_img_data, bkg_img_hdr = [], []
-            exp_img_data = []
-
-            if isinstance(bkg_img, Image):
-                if isinstance(bkg_img.data, list):
-                    raise TypeError('If the counts image is a single map, then \
-                              the background image cannot be a list of maps.')
-                else:
-                    bkg_img_data.append(bkg_img.data)
-                    bkg_img_hdr.append(bkg_img.hdr)
-            else:
-                bkg_img_data.append(bkg_img)
-                bkg_corr = [1.]
-
-            if isinstance(exp_img, Image):
-                if isinstance(exp_img.data, list):
-                    raise TypeError('If the counts image is a single map, then \
-                              the exposure image cannot be a list of maps.')
-                else:
-                    exp_img_data.append(exp_img.data)
+        Returns an int16 image covering the bounding box of the binned pixels,
+        in which each pixel is set to the label of its bin (or -1 if it is not
+        in any bin), and the (row, col) coordinates of the bottom-left corner
+        of the image.
+        """
+        if len(self) == 0:
+            return np.empty((0, 0), dtype=np.int16), (0, 0)
+        row_min, col_min = self.rows.min(), self.cols.min()
+        label_img = np.full((self.rows.max() - row_min + 1,
+                             self.cols.max() - col_min + 1), -1,
+                            dtype=np.int16)
+        label_img[self.rows - row_min, self.cols - col_min] = self.labels
+        return label_img, (row_min, col_min)
+
+    def to_tuples(self):
+        """Return the pixels as a list of (row, col, bin) tuples."""
+        return list(zip(self.rows.tolist(), self.cols.tolist(),
+                        self.labels.tolist()))
+
+def get_pixel_indices(pixels):
+    """Get the rows and columns of a set of pixels.
+
+    The pixels can be given either as a (rows, cols) tuple of arrays or as
+    a list of (row, col, ...) tuples.
+    """
+    if isinstance(pixels, list):
+        pixels = np.array([pixel[:2] for pixel in pixels],
+                          dtype=np.intp).reshape(-1, 2)
+        return pixels[:, 0], pixels[:, 1]
+    rows, cols = pixels
+    return rows, cols
+
+def get_observations(counts_img, bkg_img, exp_img):
+    """Collect the images and scaling factors of each observation.
+
+    Returns the lists of counts, background, and exposure maps, the list of
+    the (row, col) origins of the counts, background, and exposure maps of
+    each observation, and two arrays with one value per observation: the
+    factor by which the background counts are scaled to the exposure of the
+    source image, and the factor by which the exposure map is scaled to the
+    exposure of the background image. Maps that are not read in from a file
+    have the same origin as the counts image.
+    """
+    if not isinstance(counts_img.data, list):
+        counts_img_data = [counts_img.data]
+        counts_img_hdr = [counts_img.hdr]
+        counts_img_origin = [counts_img.origin]
+
+        if isinstance(bkg_img, Image):
+            if isinstance(bkg_img.data, list):
+                raise TypeError('If the counts image is a single map, then \
+                          the background image cannot be a list of maps.')
             else:
-                exp_img_data.append(exp_img)
-
+                bkg_img_data = [bkg_img.data]
+                bkg_img_hdr = [bkg_img.hdr]
+                bkg_img_origin = [bkg_img.origin]
         else:
-            bkg_corr = [None] * len(counts_img.data)
-            counts_img_data = counts_img.data
-            counts_img_hdr = counts_img.hdr
-
-            if isinstance(exp_img, Image):
-                if not isinstance(exp_img.data, list):
-                    exp_img_data = exp_img.data * len(counts_img.data)
-                elif len(exp_img.data) != len(counts_img.data):
-                    raise ValueError('Exposure map must be either a single \
-                        image, or a list of images with the same length as \
-                        the length of the list of source images.')
-                else:
-                    exp_img_data = exp_img.data
+            bkg_img_data = [bkg_img]
+            bkg_img_hdr = [getattr(bkg_img, 'hdr', None)]
+            bkg_img_origin = counts_img_origin
+
+        if isinstance(exp_img, Image):
+            if isinstance(exp_img.data, list):
+                raise TypeError('If the counts image is a single map, then \
+                          the exposure image cannot be a list of maps.')
             else:
-                exp_img_data = exp_img
-
-            if isinstance(bkg_img, Image):
-                if not isinstance(bkg_img.data, list):
-                    bkg_img_data = bkg_img.data * len(counts_img.data)
-                    bkg_img_hdr = bkg_img.hdr * len(counts_img.data)
-                elif len(bkg_img.data) != len(counts_img.data):
-                    raise ValueError('Background map must be either a single \
-                        image, or a list of images with the same length as \
-                        the length of the list of source images.')
-                else:
-                    bkg_img_data = bkg_img.data
-                    bkg_img_hdr = bkg_img.hdr
+                exp_img_data = [exp_img.data]
+                exp_img_origin = [exp_img.origin]
+        else:
+            exp_img_data = [exp_img]
+            exp_img_origin = counts_img_origin
+
+    else:
+        n_img = len(counts_img.data)
+        counts_img_data = counts_img.data
+        counts_img_hdr = counts_img.hdr
+        counts_img_origin = counts_img.origin
+
+        if isinstance(exp_img, Image):
+            if not isinstance(exp_img.data, list):
+                exp_img_data = [exp_img.data] * n_img
+                exp_img_origin = [exp_img.origin] * n_img
+            elif len(exp_img.data) != n_img:
+                raise ValueError('Exposure map must be either a single \
+                    image, or a list of images with the same length as \
+                    the length of the list of source images.')
             else:
-                bkg_img_data = bkg_img
-                bkg_corr = [1.] * len(counts_img_data)
-
-        raw_cts, net_cts, bkg_cts = 0., 0., 0.
-        raw_rate, net_rate, bkg_rate = 0., 0., 0.
-        err_raw_rate_sq, err_net_rate_sq, err_bkg_rate_sq = 0., 0., 0.
-
-        exp_raw = 0.
-        exp_bkg = 0.
-        for i in range(len(counts_img_data)):
-            if not bkg_corr[i]:
-                if not 'BKGNORM' in bkg_img_hdr[i]:
-                    bkgnorm = 1.
-                else:
-                    bkgnorm = bkg_img_hdr[i]['BKGNORM']
-                bkg_corr_i = counts_img_hdr[i]['EXPOSURE'] * bkgnorm / \
-                    bkg_img_hdr[i]['EXPOSURE']
+                exp_img_data = exp_img.data
+                exp_img_origin = exp_img.origin
+        else:
+            exp_img_data = exp_img
+            exp_img_origin = counts_img_origin
+
+        if isinstance(bkg_img, Image):
+            if not isinstance(bkg_img.data, list):
+                bkg_img_data = [bkg_img.data] * n_img
+                bkg_img_hdr = [bkg_img.hdr] * n_img
+                bkg_img_origin = [bkg_img.origin] * n_img
+            elif len(bkg_img.data) != n_img:
+                raise ValueError('Background map must be either a single \
+                    image, or a list of images with the same length as \
+                    the length of the list of source images.')
             else:
-                bkg_corr_i = bkg_corr[i]
-                bkgnorm = 1.
-            for pixel in pixels_in_bin:
-                j, k = pixel[0], pixel[1]
-                if exp_img_data[i][j, k] == 0:
-                    continue
-                exp_val = exp_img_data[i][j, k]
-                exp_val_bkg = exp_img_data[i][j, k] * \
-                              bkg_img_hdr[i]['EXPOSURE'] / \
-                              counts_img_hdr[i]['EXPOSURE']
-                raw_cts += counts_img_data[i][j, k]
-                bkg_cts += bkg_img_data[i][j, k]
-                exp_raw += exp_val
-                exp_bkg += exp_val_bkg / bkgnorm
-                net_cts += counts_img_data[i][j, k] - bkg_img_data[i][j, k] * bkg_corr_i
+                bkg_img_data = bkg_img.data
+                bkg_img_hdr = bkg_img.hdr
+                bkg_img_origin = bkg_img.origin
+        else:
+            bkg_img_data = bkg_img
+            bkg_img_hdr = [getattr(bkg, 'hdr', None) for bkg in bkg_img]
+            bkg_img_origin = counts_img_origin
+
+    bkg_corr = np.ones(len(counts_img_data))
+    exp_corr = np.ones(len(counts_img_data))
+    for i in range(len(counts_img_data)):
+        # Background maps without a header are already scaled to the
+        # source image.
+        if bkg_img_hdr[i] is None:
+            continue
+        if not 'BKGNORM' in bkg_img_hdr[i]:
+            bkgnorm = 1.
+        else:
+            bkgnorm = bkg_img_hdr[i]['BKGNORM']
+        bkg_corr[i] = counts_img_hdr[i]['EXPOSURE'] * bkgnorm / \
+            bkg_img_hdr[i]['EXPOSURE']
+        exp_corr[i] = bkg_img_hdr[i]['EXPOSURE'] / \
+            counts_img_hdr[i]['EXPOSURE'] / bkgnorm
+    origins = list(zip(counts_img_origin, bkg_img_origin, exp_img_origin))
+    return counts_img_data, bkg_img_data, exp_img_data, origins, \
+           bkg_corr, exp_corr
+
+def get_pixel_values(img_data, rows, cols, origin=(0, 0)):
+    """Get the values of the pixels at the given rows and columns.
+
+    The rows and columns are defined with respect to the full image, while
+    `img_data` may be a section of it starting at the (row, col) `origin`.
+    All the pixels must lie within `img_data`.
+    """
+    if origin[0] != 0 or origin[1] != 0:
+        rows = rows - origin[0]
+        cols = cols - origin[1]
+    if len(rows) > 0:
+        nrows, ncols = np.shape(img_data)[-2:]
+        if rows.min() < 0 or rows.max() >= nrows or \
+           cols.min() < 0 or cols.max() >= ncols:
+            error_message = ErrorMessages('005')
+            raise ValueError(error_message)
+    return img_data[rows, cols]
+
+def get_bin_sums(img_data, rows, cols, labels, nbins, origin=(0, 0)):
+    """Sum the values of the pixels in each bin.
+
+    For a `ConstantMap`, the pixels are not read, and the sums are found
+    from the number of pixels in each bin.
+    """
+    if isinstance(img_data, ConstantMap):
+        return img_data.value * np.bincount(labels, minlength=nbins)
+    return np.bincount(labels,
+                       weights=get_pixel_values(img_data, rows, cols, origin),
+                       minlength=nbins)
+
+def get_obs_bin_sums(counts_data, bkg_data, exp_data, rows, cols, labels,
+                     nbins, origins=((0, 0), (0, 0), (0, 0))):
+    """Sum the counts, background counts, and exposure in each bin.
+
+    Pixels with zero exposure are ignored. `origins` are the (row, col)
+    origins of the counts, background, and exposure maps. Returns an array
+    of shape (3, nbins) with the sums for a single observation.
+    """
+    counts_origin, bkg_origin, exp_origin = origins
+    if isinstance(exp_data, ConstantMap):
+        if exp_data.value == 0:
+            return np.zeros((3, nbins))
+        exp_sums = get_bin_sums(exp_data, rows, cols, labels, nbins)
+    else:
+        exp_vals = get_pixel_values(exp_data, rows, cols, exp_origin)
+        exposed = exp_vals != 0
+        rows, cols, labels = rows[exposed], cols[exposed], labels[exposed]
+        exp_sums = np.bincount(labels, weights=exp_vals[exposed],
+                               minlength=nbins)
+    return np.array([
+        get_bin_sums(counts_data, rows, cols, labels, nbins, counts_origin),
+        get_bin_sums(bkg_data, rows, cols, labels, nbins, bkg_origin),
+        exp_sums])
+
+def get_shared_obs_bin_sums(counts_data, bkg_data, exp_data, rows, cols,
+                            labels, nbins, origins):
+    """Same as `get_obs_bin_sums`, for arrays shared with a worker process."""
+    return get_obs_bin_sums(unshare(counts_data), unshare(bkg_data),
+                            unshare(exp_data), unshare(rows), unshare(cols),
+                            unshare(labels), nbins, origins)
+
+def share_image(img, shared):
+    """Copy an image, sharing its arrays with worker processes.
+
+    `shared` is the `SharedArrays` collection through which the arrays are
+    shared. Lists of maps and maps that are not images are also accepted.
+    """
+    if isinstance(img, list):
+        return [share_image(i, shared) for i in img]
+    if not isinstance(img, Image):
+        return shared.share(img)
+    shared_img = Image.__new__(Image)
+    shared_img.__dict__.update(img.__dict__)
+    shared_img.data = share_image(img.data, shared)
+    return shared_img
+
+def unshare_image(img):
+    """Get the arrays of an image copied with `share_image`."""
+    if isinstance(img, list):
+        return [unshare_image(i) for i in img]
+    if not isinstance(img, Image):
+        return unshare(img)
+    unshared_img = Image.__new__(Image)
+    unshared_img.__dict__.update(img.__dict__)
+    unshared_img.data = unshare_image(img.data)
+    return unshared_img
+
+def get_shared_profile(region, counts_img, bkg_img, exp_img, min_counts,
+                       islog, exclusions):
+    """Same as `Region.profile`, for images shared with a worker process."""
+    return region.profile(unshare_image(counts_img), unshare_image(bkg_img),
+                          unshare_image(exp_img), min_counts, islog,
+                          exclusions=exclusions)
+
+def batch_profile(regions, counts_img, bkg_img, exp_img, min_counts=50,
+                  islog=True, pool=None, exclusions=None):
+    """Generate count profiles for several regions on the same images.
+
+    The images are read only once, and the regions can be processed
+    concurrently by passing a pool of workers (see `parallel.get_pool`).
+    For a pool of processes, the images are shared with the workers through
+    memory-mapped files instead of being copied to each worker. The same
+    `exclusions` are removed from all the regions. Returns a list with the
+    profile of each region (see `Region.profile`).
+    """
+    bkg_img, exp_img = get_bkg_exp(counts_img, bkg_img, exp_img)
+    nregions = len(regions)
+    if is_process_pool(pool):
+        with SharedArrays() as shared:
+            return pool_map(pool, get_shared_profile, regions,
+                            [share_image(counts_img, shared)] * nregions,
+                            [share_image(bkg_img, shared)] * nregions,
+                            [share_image(exp_img, shared)] * nregions,
+                            [min_counts] * nregions, [islog] * nregions,
+                            [exclusions] * nregions)
+    return pool_map(pool, Region.profile, regions, [counts_img] * nregions,
+                    [bkg_img] * nregions, [exp_img] * nregions,
+                    [min_counts] * nregions, [islog] * nregions,
+                    [None] * nregions, [exclusions] * nregions)
+
+class Region(object):
+
+    def get_bin_vals(self, counts_img, bkg_img,
+        exp_img, pixels_in_bin, only_net_cts=False, pool=None):
+        """Calculate the number of counts in a bin.
+
+        If `pixels_in_bin` is a `PixelBins` object, then the values are
+        calculated for all the bins at once and are returned as arrays with
+        one element per bin. The counts in each bin are summed over all the
+        observations.
+
+        The observations can be processed concurrently by passing a pool of
+        workers (see `parallel.get_pool`). For a pool of processes, the
+        images are shared with the workers through memory-mapped files
+        instead of being copied to each worker. The results are the same as
+        when the observations are processed serially.
+        """
+        counts_img_data, bkg_img_data, exp_img_data, origins, \
+            bkg_corr, exp_corr = get_observations(counts_img, bkg_img,
+                                                  exp_img)
+
+        if isinstance(pixels_in_bin, PixelBins):
+            rows, cols = pixels_in_bin.rows, pixels_in_bin.cols
+            labels = pixels_in_bin.labels
+            nbins = pixels_in_bin.nbins
+        else:
+            rows, cols = get_pixel_indices(pixels_in_bin)
+            labels = np.zeros(len(rows), dtype=np.intp)
+            nbins = 1
+
+        # Sums of the counts, background counts, and exposure, with shape
+        # (observation, quantity, bin).
+        nobs = len(counts_img_data)
+        if is_process_pool(pool):
+            with SharedArrays() as shared:
+                sums = pool_map(pool, get_shared_obs_bin_sums,
+                                map(shared.share, counts_img_data),
+                                map(shared.share, bkg_img_data),
+                                map(shared.share, exp_img_data),
+                                [shared.share(rows)] * nobs,
+                                [shared.share(cols)] * nobs,
+                                [shared.share(labels)] * nobs,
+                                [nbins] * nobs, origins)
+        else:
+            sums = pool_map(pool, get_obs_bin_sums, counts_img_data,
+                            bkg_img_data, exp_img_data, [rows] * nobs,
+                            [cols] * nobs, [labels] * nobs, [nbins] * nobs,
+                            origins)
+        sums = np.array(sums)
+        sums = sums.reshape(-1, 3, nbins)
+        raw_cts = np.sum(sums[:, 0], axis=0)
+        bkg_cts = np.sum(sums[:, 1], axis=0)
+        net_cts = raw_cts - np.dot(bkg_corr, sums[:, 1])
+        exp_raw = np.sum(sums[:, 2], axis=0)
+        exp_bkg = np.dot(exp_corr, sums[:, 2])
+
+        if not isinstance(pixels_in_bin, PixelBins):
+            raw_cts, net_cts, bkg_cts, exp_raw, exp_bkg = \
+                raw_cts[0], net_cts[0], bkg_cts[0], exp_raw[0], exp_bkg[0]
         if only_net_cts:
             return net_cts
         raw_rate = raw_cts / exp_raw
@@ -113,40 +392,37 @@ class Region(object):
         return raw_cts, net_cts, bkg_cts, \
                raw_rate, err_raw_rate, net_rate, err_net_rate, bkg_rate, err_bkg_rate
 
-    def merge_bins(self, counts_img, bkg_img, exp_img,
-                   min_counts, islog=True):
-        bkg_img, exp_img = get_bkg_exp(counts_img, bkg_img, exp_img)
-        edges = self.make_edges(islog)
-        pixels_in_bins = self.distribute_pixels(edges)
-        nbins = len(edges) - 1
-        npix = len(pixels_in_bins)
-        bins = []
-        start_edge = edges[0]
-        pixels_in_current_bin = []
-        for i in range(nbins):
-            end_edge = edges[i+1]
-            pixels_in_current_bin.extend(
-                    [(pixels_in_bins[j][0], pixels_in_bins[j][1])
-                      for j in range(npix) if pixels_in_bins[j][2] == i])
-            net_counts = self.get_bin_vals(counts_img, bkg_img, exp_img,
-                             pixels_in_current_bin, only_net_cts=True)
-            if net_counts < min_counts:
-                if end_edge == edges[-1] and len(bins) != 0:
-                    bins[-1][2].extend(pixels_in_current_bin)
-                    updated_last_bin = (bins[-1][0], end_edge, bins[-1][2])
-                    bins[-1] = updated_last_bin
-                elif end_edge == edges[-1] and len(bins) == 0:
-                    error_message = ErrorMessages('001')
-                    raise ValueError(error_message)
-                else:
-                    continue
-            else:
-                bins.append((start_edge, end_edge, pixels_in_current_bin))
-                start_edge = end_edge
-                pixels_in_current_bin = []
-        return bins
+    def get_net_counts(self, counts_img, bkg_img, exp_img, pixels_in_bins,
+                       pool=None):
+        """Calculate the number of net counts in each bin."""
+        return self.get_bin_vals(counts_img, bkg_img, exp_img,
+                                 pixels_in_bins, only_net_cts=True, pool=pool)
 
-    def profile(self, counts_img, bkg_img, exp_img, min_counts=50, islog=True):
+    def merge_bins(self, counts_img, bkg_img, exp_img,
+                   min_counts, islog=True, pixels_in_bins=None,
+                   net_counts=None, pool=None, exclusions=None):
+        """Merge adjacent bins until each has at least `min_counts` net counts.
+
+        The net counts are calculated only once for each of the initial bins,
+        and are then merged using cumulative sums. To merge the same bins
+        again with a different `min_counts`, the pixels returned by
+        `distribute_pixels` and the net counts returned by `get_net_counts`
+        can be passed in through `pixels_in_bins` and `net_counts`. Pixels
+        inside `exclusions` are left out of the bins.
+
+        Returns the merged bins as a `PixelBins` object.
+        """
+        if pixels_in_bins is None:
+            pixels_in_bins = self.distribute_pixels(self.make_edges(islog),
+                                                    exclusions)
+        if net_counts is None:
+            bkg_img, exp_img = get_bkg_exp(counts_img, bkg_img, exp_img)
+            net_counts = self.get_net_counts(counts_img, bkg_img, exp_img,
+                                             pixels_in_bins, pool=pool)
+        return pixels_in_bins.merge(merge_net_counts(net_counts, min_counts))
+
+    def profile(self, counts_img, bkg_img, exp_img, min_counts=50, islog=True,
+                pool=None, exclusions=None):
         """Generate count profiles.
 
         The box is divided into bins based on a minimum number of counts or a
@@ -173,21 +449,28 @@ class Region(object):
 
         If a background map is not read in, then the background is set to zero.
         If an exposure map is not read in, then the exposure is set to one
-        everywhere. However, if point source exclusion is important, then an
-        exposure map is necessary; regions with zero exposure will be ignored,
-        so they need to be masked in the exposure map. Removing point sources
-        from the exposure map with dmcopy can be very slow if the full field of
-        view is not included in the region file. So to quicken things up, the
-        region file should look something like:
+        everywhere. Pixels with zero exposure are ignored.
+
+        Point sources can be excluded by passing an `Exclusions` object, read
+        from a region file that looks something like:
 
                 field()
                 -ellipse(......)
                 -circle(......)
 
-        The function returns a list of tuples of the form:
-        (bin radius, bin width, source counts, source counts uncertainty,
-        background counts, background counts uncertainty, net counts,
-        net counts uncertainty)
+        with `load_exclusions`. The excluded circles, ellipses, and boxes are
+        rasterized into a mask over the region, and the masked pixels are left
+        out of the bins. The mask is cached in the `Exclusions` object, so it
+        is made only once when several profiles of the same region are
+        generated. Masking the point sources in the exposure map (e.g. with
+        dmcopy) is therefore not necessary.
+
+        The function returns a `ProfileTable` with one row per bin, and the
+        columns: bin radius, bin width, source counts, net counts, background
+        counts, source rate and its uncertainty, net rate and its
+        uncertainty, background rate and its uncertainty, and the factors
+        that convert source and background rates to counts (see
+        `table.PROFILE_COLUMNS` for the column names).
         """
         bkg_img, exp_img = get_bkg_exp(counts_img, bkg_img, exp_img)
         if isinstance(counts_img.hdr, list):
@@ -196,23 +479,16 @@ class Region(object):
             pix2arcmin = counts_img.hdr['CDELT2'] * 60.
 
         bins = self.merge_bins(counts_img, bkg_img, exp_img,
-                               min_counts, islog)
-
-        profile = []
-        for current_bin in bins:
-            raw_cts, net_cts, bkg_cts, \
-                raw_rate, err_raw_rate, net_rate, err_net_rate, \
-                bkg_rate, err_bkg_rate = \
-                    self.get_bin_vals(counts_img, bkg_img, exp_img,
-                                      current_bin[2])
-            bin_radius = (current_bin[0] + current_bin[1]) / 2.
-            bin_width = current_bin[1] - bin_radius
-            bin_values = (bin_radius, bin_width, raw_cts, 
-                          net_cts, bkg_cts, 
-                          raw_rate, err_raw_rate, net_rate, err_net_rate,
-                          bkg_rate, err_bkg_rate)
-            bin_values = bin_pix2arcmin(bin_values, pix2arcmin)
-            profile.append(bin_values)
+                               min_counts, islog, exclusions=exclusions)
+
+        bin_vals = self.get_bin_vals(counts_img, bkg_img, exp_img, bins)
+
+        edges = np.asarray(bins.edges)
+        bin_radius = (edges[:-1] + edges[1:]) / 2.
+        bin_width = edges[1:] - bin_radius
+        bin_values = bin_pix2arcmin((bin_radius, bin_width) + tuple(bin_vals),
+                                    pix2arcmin)
+        profile = ProfileTable.from_columns(bin_values)
         return profile
 
     def counts_profile(self, counts_img, bkg_img, bkg_err_img, exp_img,
@@ -239,15 +515,15 @@ class Region(object):
         this routine, by just calling count_profile to get the data. This would
         allow for more customization than this routine provides.
         """
-        nbins = len(profile)
+        profile = ProfileTable.from_rows(profile)
 
-        r = np.array([profile[i][0] for i in range(nbins)])
-        r_err = np.array([profile[i][1] for i in range(nbins)])
+        r = profile['radius']
+        r_err = profile['width']
 
-        bkg = np.array([profile[i][5] for i in range(nbins)])
-        bkg_err = np.array([profile[i][6] for i in range(nbins)])
-        net_cts = np.array([profile[i][7] for i in range(nbins)])
-        err_net_cts = np.array([profile[i][8] for i in range(nbins)])
+        bkg = profile['bkg_rate']
+        bkg_err = profile['err_bkg_rate']
+        net_cts = profile['net_rate']
+        err_net_cts = profile['err_net_rate']
 
         plt.scatter(r, net_cts, c="#1e8f1e", alpha=0.85, s=35, marker="s")
         plt.errorbar(r, net_cts, xerr=r_err, yerr=err_net_cts,
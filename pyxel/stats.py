@@ -1,93 +1,298 @@
 import numpy as np
 
+def get_cstat_branches(measured_raw_cts, measured_bkg_cts):
+    """Classify the bins by the C-statistic branch that applies to them.
+
+    Returns three boolean masks, for the bins with background counts but no
+    source counts, the bins with source counts but no background counts,
+    and all the other bins.
+    """
+    only_bkg = (measured_raw_cts == 0) & (measured_bkg_cts > 0)
+    only_raw = (measured_bkg_cts == 0) & (measured_raw_cts > 0)
+    return only_bkg, only_raw, ~(only_bkg | only_raw)
+
+def sum_bins(values):
+    """Sum the values of the bins, which are stored along the last axis.
+
+    The bins are added one at a time and in order, as in a loop over the
+    bins, so that the sums do not depend on how numpy groups the terms.
+    """
+    if values.shape[-1] == 0:
+        return np.zeros(values.shape[:-1])
+    return np.cumsum(values, axis=-1)[..., -1]
+
+def has_derivatives(model):
+    """Check whether a model has analytic derivatives with respect to its
+    parameters, i.e. a `fit_deriv` or an `evaluate_with_derivatives`
+    method."""
+    return getattr(model, 'fit_deriv', None) is not None or \
+        hasattr(model, 'evaluate_with_derivatives')
+
+def get_model_vals_and_derivs(updated_model, x):
+    """Evaluate a model and its derivatives with respect to its parameters.
+
+    Models that have an `evaluate_with_derivatives` method return both from
+    a single computation. For other models, the model and `fit_deriv` are
+    evaluated separately.
+    """
+    params = updated_model.parameters
+    if hasattr(updated_model, 'evaluate_with_derivatives'):
+        model_vals, model_derivs = \
+            updated_model.evaluate_with_derivatives(x, *params)
+    else:
+        model_derivs = updated_model.fit_deriv(x, *params)
+        model_vals = updated_model(x)
+    return np.asarray(model_vals, dtype=float), np.array(model_derivs)
+
+def cstat_deriv_from_vals(measured_raw_cts, model_vals, model_derivs,
+                          measured_bkg_cts, t_raw, t_bkg):
+    """
+    Calculates the derivatives of the C-statistic from the model values and
+    the model derivatives in each bin.
+
+    `model_vals` has the bins along its last axis, and `model_derivs` has an
+    extra axis before it for the parameters. Leading axes (e.g. one for each
+    set of parameters) are kept.
+    """
+    measured_raw_cts = np.asarray(measured_raw_cts)
+    measured_bkg_cts = np.asarray(measured_bkg_cts)
+    model_vals = np.asarray(model_vals, dtype=float)[..., np.newaxis, :]
+    model_derivs = np.asarray(model_derivs, dtype=float)
+    only_bkg, only_raw, other = get_cstat_branches(measured_raw_cts,
+                                                   measured_bkg_cts)
+    tmp1 = t_raw + t_bkg
+    d_cash = np.empty(np.broadcast(model_vals, model_derivs).shape)
+
+    d_cash[..., only_bkg] = t_raw[only_bkg] * model_derivs[..., only_bkg]
+
+    raw_cts = measured_raw_cts[only_raw]
+    vals = model_vals[..., only_raw]
+    derivs = model_derivs[..., only_raw]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d_cash[..., only_raw] = np.where(
+            tmp1[only_raw] * vals < raw_cts,
+            -(t_bkg[only_raw] * derivs),
+            t_raw[only_raw] * derivs - raw_cts * 1. / vals * derivs)
+
+    # Some of these calculations are used often, so they are done only once
+    # here to speed up the code.
+    raw_cts = measured_raw_cts[other]
+    bkg_cts = measured_bkg_cts[other]
+    vals = model_vals[..., other]
+    derivs = model_derivs[..., other]
+    tmp1 = tmp1[other]
+    tmp2 = tmp1 * vals
+    tmp3 = tmp2 - raw_cts - bkg_cts
+    tmp4 = tmp2 * bkg_cts
+    tmp5 = tmp1 * derivs
+    tmp6 = tmp5 * bkg_cts
+    tmp7 = t_raw[other] * derivs
+
+    d = (tmp3 ** 2 + 4. * tmp4)**0.5
+    f = (-tmp3 + d) / (2. * tmp1)
+
+    d_d = (tmp3 ** 2 + 4. * tmp4)**-0.5 * (2. * tmp6 + tmp3 * tmp5)
+    d_f = -0.5 * derivs + d_d / (2. * tmp1)
+
+    d_cash[..., other] = tmp7 + tmp1 * d_f - \
+                         raw_cts * 1. / (vals + f) * (derivs + d_f) - \
+                         bkg_cts * 1. / f * d_f
+    return 2. * sum_bins(d_cash)
+
 def cstat_deriv(measured_raw_cts, updated_model, measured_bkg_cts,
-                      t_raw, t_bkg, x):
+                      t_raw, t_bkg, x, model_vals=None, model_derivs=None):
     """
     Calculates the derivatives of the C-statistic.
+
+    The model values and derivatives can be passed in if they have already
+    been calculated, e.g. with `get_model_vals_and_derivs`.
+    """
+    if model_vals is None or model_derivs is None:
+        model_vals, model_derivs = get_model_vals_and_derivs(updated_model, x)
+    return cstat_deriv_from_vals(measured_raw_cts, model_vals, model_derivs,
+                                 measured_bkg_cts, t_raw, t_bkg)
+
+def cstat_from_vals(measured_raw_cts, model_vals, measured_bkg_cts, t_raw,
+                    t_bkg):
+    """
+    Calculates the C-statistic from the model values in each bin.
+
+    `model_vals` has the bins along its last axis. Leading axes (e.g. one for
+    each set of parameters) are kept, so that the statistic can be calculated
+    for several models at once.
     """
-    model_derivs = np.array(updated_model.fit_deriv(x, *updated_model.parameters))
-    model_vals = updated_model(x)
+    measured_raw_cts = np.asarray(measured_raw_cts)
+    measured_bkg_cts = np.asarray(measured_bkg_cts)
+    model_vals = np.asarray(model_vals, dtype=float)
+    only_bkg, only_raw, other = get_cstat_branches(measured_raw_cts,
+                                                   measured_bkg_cts)
+    tmp1 = t_raw + t_bkg
+    cash = np.empty(model_vals.shape)
+
+    cash[..., only_bkg] = t_raw[only_bkg] * model_vals[..., only_bkg] - \
+        measured_bkg_cts[only_bkg] * np.log(t_bkg[only_bkg] / tmp1[only_bkg])
 
-    nbins = len(model_vals)
-    nparams = len(updated_model.parameters)
-    d_cash = np.zeros(nparams)
+    raw_cts = measured_raw_cts[only_raw]
+    vals = model_vals[..., only_raw]
+    tmp5 = t_raw[only_raw] * vals
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cash[..., only_raw] = np.where(
+            tmp1[only_raw] * vals < raw_cts,
+            -(t_bkg[only_raw] * vals +
+              raw_cts * np.log(t_raw[only_raw] / tmp1[only_raw])),
+            tmp5 + raw_cts * (np.log(raw_cts / tmp5) - 1))
 
     # Some of these calculations are used often, so they are done only once
     # here to speed up the code.
-    tmp1 = t_raw + t_bkg
-    tmp2 = tmp1 * model_vals
-    tmp3 = tmp2 - measured_raw_cts - measured_bkg_cts
-    tmp4 = tmp2 * measured_bkg_cts
-    tmp5 = tmp1 * model_derivs
-    tmp6 = tmp5 * measured_bkg_cts
-    tmp7 = t_raw * model_derivs
-    tmp8 = t_bkg * model_derivs
+    raw_cts = measured_raw_cts[other]
+    bkg_cts = measured_bkg_cts[other]
+    vals = model_vals[..., other]
+    tmp1 = tmp1[other]
+    tmp2 = tmp1 * vals
+    tmp3 = tmp2 - raw_cts - bkg_cts
+    tmp4 = tmp2 * bkg_cts
+    tmp5 = t_raw[other] * vals
 
     d = (tmp3 ** 2 + 4. * tmp4)**0.5
     f = (-tmp3 + d) / (2. * tmp1)
 
-    d_d = (tmp3 ** 2 + 4. * tmp4)**-0.5 * (2. * tmp6 + tmp3 * tmp5)
-    d_f = -0.5 * model_derivs + d_d / (2. * tmp1)
-
-    for i in range(nbins):
-        if measured_raw_cts[i] == 0 and measured_bkg_cts[i] > 0:
-            d_cash += tmp7[:,i]
-        elif measured_bkg_cts[i] == 0 and measured_raw_cts[i] > 0:
-            if tmp2[i] < measured_raw_cts[i]:
-                d_cash -= tmp8[:,i]
-            else:
-                d_cash += tmp7[:,i] - \
-                          measured_raw_cts[i] * 1. / model_vals[i] * \
-                          model_derivs[:,i]
-        else:
-            d_cash += tmp7[:,i] + tmp1[i] * d_f[:,i] - \
-                      measured_raw_cts[i] * \
-                      1. / (model_vals[i] + f[i]) * \
-                      (model_derivs[:,i] + d_f[:,i]) - \
-                      measured_bkg_cts[i] * 1. / f[i] * d_f[:,i]
-    return 2. * d_cash
-
-def cstat(measured_raw_cts, updated_model, measured_bkg_cts, t_raw, t_bkg, x):
+    cash[..., other] = tmp5 + tmp1 * f - \
+        raw_cts * np.log(t_raw[other] * (vals + f)) - \
+        bkg_cts * np.log(t_bkg[other] * f) - \
+        raw_cts * (1 - np.log(raw_cts)) - \
+        bkg_cts * (1 - np.log(bkg_cts))
+    return 2. * sum_bins(cash)
+
+def cstat(measured_raw_cts, updated_model, measured_bkg_cts, t_raw, t_bkg, x,
+          model_vals=None):
     """
     C-statistic implementation. [1][2]
 
     This algorithm requires total and background counts, as well as the
-    factors that transform counts to rates.
+    factors that transform counts to rates. The three cases of the statistic
+    (bins without source counts, bins without background counts, and all
+    other bins) are evaluated for all the bins at once, see
+    `cstat_from_vals`. The model values can be passed in if they have
+    already been calculated.
 
     .. [1] Cash, W. (1979), "Parameter estimation in astronomy through
            application of the likelihood ratio", ApJ, 228, p. 939-947
     .. [2] Wachter, K., Leach, R., Kellogg, E. (1979), "Parameter estimation
            in X-ray astronomy using maximum likelihood", ApJ, 230, p. 274-287
     """
-    model_vals = updated_model(x)
+    if model_vals is None:
+        model_vals = updated_model(x)
+    return cstat_from_vals(measured_raw_cts, model_vals, measured_bkg_cts,
+                           t_raw, t_bkg)
 
-    # Some of these calculations are used often, so they are done only once
-    # here to speed up the code.
+def cstat_bkg_rates(measured_raw_cts, model_vals, measured_bkg_cts, t_raw,
+                    t_bkg):
+    """
+    Calculates the background rate in each bin that maximizes the
+    likelihood for the given model values.
+
+    These are the background rates that are profiled out of the C-statistic
+    (see `cstat_from_vals`). Together with the model values, they give the
+    expected source and background counts, e.g. to simulate data.
+    `model_vals` has the bins along its last axis, and leading axes are kept.
+    """
+    measured_raw_cts = np.asarray(measured_raw_cts)
+    measured_bkg_cts = np.asarray(measured_bkg_cts)
+    model_vals = np.asarray(model_vals, dtype=float)
+    only_bkg, only_raw, other = get_cstat_branches(measured_raw_cts,
+                                                   measured_bkg_cts)
     tmp1 = t_raw + t_bkg
-    tmp2 = tmp1 * model_vals
-    tmp3 = tmp2 - measured_raw_cts - measured_bkg_cts
-    tmp4 = tmp2 * measured_bkg_cts
-    tmp5 = t_raw * model_vals
-    tmp6 = t_bkg * model_vals
+    bkg_rates = np.empty(model_vals.shape)
+
+    bkg_rates[..., only_bkg] = measured_bkg_cts[only_bkg] / tmp1[only_bkg]
+
+    bkg_rates[..., only_raw] = np.maximum(
+        measured_raw_cts[only_raw] / tmp1[only_raw] -
+        model_vals[..., only_raw], 0.)
+
+    raw_cts = measured_raw_cts[other]
+    bkg_cts = measured_bkg_cts[other]
+    vals = model_vals[..., other]
+    tmp1 = tmp1[other]
+    tmp3 = tmp1 * vals - raw_cts - bkg_cts
+    tmp4 = tmp1 * vals * bkg_cts
+
+    d = (tmp3 ** 2 + 4. * tmp4)**0.5
+    bkg_rates[..., other] = (-tmp3 + d) / (2. * tmp1)
+    return bkg_rates
+
+def cstat_curvature(measured_raw_cts, model_vals, measured_bkg_cts, t_raw,
+                    t_bkg):
+    """
+    Calculates the second derivative of the C-statistic of each bin with
+    respect to the model value in the bin.
+
+    The background is profiled out as in `cstat`, so for the bins with both
+    source and background counts the derivative includes the change of the
+    profiled background with the model value. `model_vals` has the bins
+    along its last axis, and leading axes are kept.
+    """
+    measured_raw_cts = np.asarray(measured_raw_cts)
+    measured_bkg_cts = np.asarray(measured_bkg_cts)
+    model_vals = np.asarray(model_vals, dtype=float)
+    only_bkg, only_raw, other = get_cstat_branches(measured_raw_cts,
+                                                   measured_bkg_cts)
+    tmp1 = t_raw + t_bkg
+    curvature = np.empty(model_vals.shape)
+
+    # The statistic is linear in the model value in these bins.
+    curvature[..., only_bkg] = 0.
+
+    raw_cts = measured_raw_cts[only_raw]
+    vals = model_vals[..., only_raw]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curvature[..., only_raw] = np.where(
+            tmp1[only_raw] * vals < raw_cts, 0., raw_cts / vals**2)
+
+    raw_cts = measured_raw_cts[other]
+    bkg_cts = measured_bkg_cts[other]
+    vals = model_vals[..., other]
+    tmp1 = tmp1[other]
+    tmp3 = tmp1 * vals - raw_cts - bkg_cts
+    tmp4 = tmp1 * vals * bkg_cts
 
     d = (tmp3 ** 2 + 4. * tmp4)**0.5
     f = (-tmp3 + d) / (2. * tmp1)
 
-    nbins = len(model_vals)
-    cash = 0.
-    for i in range(nbins):
-        if measured_raw_cts[i] == 0 and measured_bkg_cts[i] > 0:
-            cash += tmp5[i] - measured_bkg_cts[i] * np.log(t_bkg[i] / tmp1[i])
-        elif measured_bkg_cts[i] == 0 and measured_raw_cts[i] > 0:
-            if tmp2[i] < measured_raw_cts[i]:
-                cash -= tmp6[i] + measured_raw_cts[i] * np.log(t_raw[i] / tmp1[i])
-            else:
-                cash += tmp5[i] + measured_raw_cts[i] * \
-                        (np.log(measured_raw_cts[i]/tmp5[i]) - 1)
-        else:
-            cash += tmp5[i] + tmp1[i] * f[i] - \
-                    measured_raw_cts[i] * np.log(t_raw[i] * (model_vals[i] + f[i])) \
-                    - measured_bkg_cts[i] * np.log(t_bkg[i] * f[i]) - \
-                    measured_raw_cts[i] * (1 - np.log(measured_raw_cts[i])) - \
-                    measured_bkg_cts[i] * (1 - np.log(measured_bkg_cts[i]))
-    return 2. * cash
+    # Since the background maximizes the likelihood, the first derivative
+    # reduces to t_raw - raw_cts / (vals + f), and only the change of f
+    # with the model value, d_f, enters the second derivative.
+    d_f = -0.5 + (tmp3 + 2. * bkg_cts) / (2. * d)
+    curvature[..., other] = raw_cts / (vals + f)**2 * (1. + d_f)
+    return curvature
+
+def cstat_hess_from_vals(measured_raw_cts, model_vals, model_derivs,
+                         measured_bkg_cts, t_raw, t_bkg):
+    """
+    Calculates the Hessian of the C-statistic with respect to the model
+    parameters from the model values and derivatives in each bin.
+
+    The Hessian is built from the first derivatives of the model only: the
+    term with the second derivatives of the model, whose expectation is zero
+    at the best fit, is neglected. The result is therefore always positive
+    semi-definite. `model_derivs` has the parameters along its second to last
+    axis and the bins along its last axis, and leading axes are kept.
+    """
+    model_derivs = np.asarray(model_derivs, dtype=float)
+    curvature = cstat_curvature(measured_raw_cts, model_vals,
+                                measured_bkg_cts, t_raw, t_bkg)
+    return 2. * np.einsum('...in,...n,...jn->...ij', model_derivs,
+                          curvature, model_derivs)
+
+def cstat_hess(measured_raw_cts, updated_model, measured_bkg_cts, t_raw,
+               t_bkg, x, model_vals=None, model_derivs=None):
+    """
+    Calculates the Hessian of the C-statistic, see `cstat_hess_from_vals`.
+
+    The model values and derivatives can be passed in if they have already
+    been calculated, e.g. with `get_model_vals_and_derivs`.
+    """
+    if model_vals is None or model_derivs is None:
+        model_vals, model_derivs = get_model_vals_and_derivs(updated_model, x)
+    return cstat_hess_from_vals(measured_raw_cts, model_vals, model_derivs,
+                                measured_bkg_cts, t_raw, t_bkg)
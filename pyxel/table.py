@@ -0,0 +1,72 @@
+import numpy as np
+
+# Columns of a profile, in the order in which they are stored.
+PROFILE_COLUMNS = ('radius', 'width', 'raw_cts', 'net_cts', 'bkg_cts',
+                   'raw_rate', 'err_raw_rate', 'net_rate', 'err_net_rate',
+                   'bkg_rate', 'err_bkg_rate', 't_raw', 't_bkg')
+
+PROFILE_DTYPE = np.dtype([(name, np.float64) for name in PROFILE_COLUMNS])
+
+class ProfileTable(object):
+    """Table of profile values, with one row per bin.
+
+    The table is backed by a numpy structured array with the fields listed
+    in `PROFILE_COLUMNS`. Columns are accessed by name and are returned as
+    views of the table, e.g. `profile['radius']`. Rows are accessed by
+    position, and can be unpacked like the tuples of the list that was
+    returned by older versions of `Region.profile`. Slices and boolean masks
+    return a new table.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Make a table from a sequence of columns, in the order of
+        `PROFILE_COLUMNS`."""
+        columns = [np.atleast_1d(column) for column in columns]
+        data = np.empty(len(columns[0]), dtype=PROFILE_DTYPE)
+        for name, column in zip(PROFILE_COLUMNS, columns):
+            data[name] = column
+        return cls(data)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Make a table from a sequence of rows, such as a list of tuples."""
+        if isinstance(rows, ProfileTable):
+            return rows
+        return cls(np.array([tuple(row) for row in rows],
+                            dtype=PROFILE_DTYPE))
+
+    @property
+    def columns(self):
+        return self.data.dtype.names
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, str) or isinstance(key, (int, np.integer)):
+            return self.data[key]
+        return ProfileTable(self.data[key])
+
+    def select(self, minrange, maxrange):
+        """Select the bins with radii between `minrange` and `maxrange`."""
+        radius = self.data['radius']
+        return self[(minrange <= radius) & (radius <= maxrange)]
+
+    def save(self, filename):
+        """Save the table to a binary .npy file.
+
+        The .npy extension is appended to the file name if it is not
+        already there.
+        """
+        np.save(filename, self.data)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a table saved with `save`."""
+        return cls(np.load(filename))
@@ -1,24 +1,8 @@
 import numpy as np
 
-from .load_data import Image
-
-def clean_header(hdr):
-    """Remove unwanted keywords from the image header.
-
-    Deletes from the image header unncessary keywords such as HISTORY and
-    COMMENT, as well as keywords associated with a 3rd and 4th dimension
-    (e.g. NAXIS3, NAXIS4). Some radio images are 4D, but the 3rd and 4th
-    dimensions are not necessary for plotting the brightness and may
-    occasionally cause problems.
-    """
-    forbidden_keywords = {'HISTORY', 'COMMENT', 'NAXIS3', 'NAXIS4',
-        'CTYPE3', 'CTYPE4', 'CRVAL3', 'CRVAL4', 'CDELT3', 'CDELT4',
-        'CRPIX3', 'CRPIX4', 'CUNIT3', 'CUNIT4'}
-    existing_keywords = [key for key in forbidden_keywords if key in hdr]
-    if any(existing_keywords):
-        for key in existing_keywords:
-            del hdr[key]
-    return hdr
+from .load_data import Image, ConstantMap
+from .messages import ErrorMessages
+from .table import ProfileTable
 
 def rotate_point(x0, y0, x, y, angle):
     """Rotate point (x,y) counter-clockwise around (x0,y0)."""
@@ -38,37 +22,41 @@ def bin_pix2arcmin(bin_values, pix2arcmin):
         [i / pix2arcmin**2 for i in [raw_rate, net_rate, bkg_rate,
         err_raw_rate, err_net_rate, err_bkg_rate]]
     t_raw = raw_cts / raw_rate
-    if bkg_rate > 0:
-        t_bkg = bkg_cts / bkg_rate
-    else:
-        t_bkg = 0.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_bkg = np.where(bkg_rate > 0, bkg_cts / bkg_rate, 0.)
     return (bin_radius, bin_width, raw_cts, net_cts,  
             bkg_cts, raw_rate, err_raw_rate, net_rate, err_net_rate, 
             bkg_rate, err_bkg_rate, t_raw, t_bkg)
 
 def get_bkg_exp(counts_img, bkg_img, exp_img):
+    """Fill in missing background and exposure maps.
+
+    Missing background maps are replaced by a zero background, and missing
+    exposure maps by an exposure of one everywhere. Neither is stored pixel
+    by pixel, but as a `ConstantMap`.
+    """
     if isinstance(counts_img.data, list):
         n_img = len(counts_img.data)
         if not bkg_img:
-            bkg_img = []
-            for i in range(n_img):
-                bkg_img.append(np.zeros_like(counts_img.data[i]))
+            bkg_img = [ConstantMap(0.) for i in range(n_img)]
         elif isinstance(bkg_img, Image):
             pass
+        elif isinstance(bkg_img, ConstantMap):
+            bkg_img = [bkg_img] * n_img
         elif isinstance(bkg_img, list):
             if n_img != len(bkg_img):
                 raise TypeError('List of background images should have the \
                     same length as the list of source images.')
             else:
                 for i in range(n_img):
-                    if not bkg_img[i]:
-                        bkg_img[i] = np.zeros_like(counts_img.data[i])
+                    if bkg_img[i] is None:
+                        bkg_img[i] = ConstantMap(0.)
         else:
             raise TypeError('Unrecognized background image format.')
     else:
         if not bkg_img:
-            bkg_img = np.zeros_like(counts_img.data)
-        elif isinstance(bkg_img, Image):
+            bkg_img = ConstantMap(0.)
+        elif isinstance(bkg_img, (Image, ConstantMap)):
             pass
         else:
             raise TypeError('Unrecognized background image format.')
@@ -76,25 +64,25 @@ def get_bkg_exp(counts_img, bkg_img, exp_img):
     if isinstance(counts_img.data, list):
         n_img = len(counts_img.data)
         if not exp_img:
-            exp_img = []
-            for i in range(n_img):
-                exp_img.append(np.zeros_like(counts_img.data[i]))
+            exp_img = [ConstantMap(1.) for i in range(n_img)]
         elif isinstance(exp_img, Image):
             pass
+        elif isinstance(exp_img, ConstantMap):
+            exp_img = [exp_img] * n_img
         elif isinstance(exp_img, list):
             if n_img != len(exp_img):
                 raise TypeError('List of exposure images should have the \
                     same length as the list of source images.')
             else:
                 for i in range(n_img):
-                    if not exp_img[i]:
-                        exp_img[i] = np.zeros_like(counts_img.data[i])
+                    if exp_img[i] is None:
+                        exp_img[i] = ConstantMap(1.)
         else:
             raise TypeError('Unrecognized exposure image format.')
     else:
         if not exp_img:
-            exp_img = np.zeros_like(counts_img.data)
-        elif isinstance(exp_img, Image):
+            exp_img = ConstantMap(1.)
+        elif isinstance(exp_img, (Image, ConstantMap)):
             pass
         else:
             raise TypeError('Unrecognized exposure image format.')
@@ -110,6 +98,28 @@ def merge_subpixel_bins(edges):
     new_edges[-1] = edges[-1]
     return new_edges
 
+def merge_net_counts(net_counts, min_counts):
+    """Merge adjacent bins until each has at least `min_counts` net counts.
+
+    The merging is done on the cumulative sum of the net counts in the
+    bins, so that the net counts in any group of adjacent bins are found
+    without summing the bins again. If the last bins do not have enough
+    net counts, they are merged into the previous bin. Returns the indices
+    of the edges of the merged bins.
+    """
+    nbins = len(net_counts)
+    cum_net_counts = np.concatenate(([0.], np.cumsum(net_counts)))
+    merged_edges = [0]
+    for i in range(1, nbins + 1):
+        if cum_net_counts[i] - cum_net_counts[merged_edges[-1]] >= min_counts:
+            merged_edges.append(i)
+    if merged_edges[-1] != nbins:
+        if len(merged_edges) == 1:
+            error_message = ErrorMessages('001')
+            raise ValueError(error_message)
+        merged_edges[-1] = nbins
+    return merged_edges
+
 def get_edges(max_r, islog):
     if not islog:
         nbins = np.round(max_r)
@@ -134,20 +144,24 @@ def get_edges(max_r, islog):
         return merge_subpixel_bins(edges)
 
 def get_data_for_chi(profile, minrange, maxrange):
+    profile = ProfileTable.from_rows(profile)
     nbins = len(profile)
-    r = np.array([profile[i][0] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    w = np.array([profile[i][1] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    net = np.array([profile[i][7] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    net_err = np.array([profile[i][8] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
+    profile = profile.select(minrange, maxrange)
+    r = profile['radius']
+    w = profile['width']
+    net = profile['net_rate']
+    net_err = profile['err_net_rate']
     return nbins, r, w, net, net_err
 
 def get_data_for_cash(profile, minrange, maxrange):
+    profile = ProfileTable.from_rows(profile)
     nbins = len(profile)
-    r = np.array([profile[i][0] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    w = np.array([profile[i][1] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    raw_cts = np.array([profile[i][2] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    bkg = np.array([profile[i][5] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
-    sb_to_counts_factor = np.array([profile[i][9] for i in range(nbins) if minrange <= profile[i][0] <= maxrange])
+    profile = profile.select(minrange, maxrange)
+    r = profile['radius']
+    w = profile['width']
+    raw_cts = profile['raw_cts']
+    bkg = profile['bkg_cts']
+    sb_to_counts_factor = profile['t_raw']
     return nbins, r, w, raw_cts, bkg, sb_to_counts_factor
 
 def call_model(func_name):
@@ -12,7 +12,7 @@ setup(name='pyxel',
           'matplotlib>=1.5.1',
           'numpy>=1.11',
           'scipy>=0.17',
-          'emcee>=2.1',
+          'emcee>=3.0',
           'corner>=1.0.2',
           'tabulate>=0.7.5'
       ]
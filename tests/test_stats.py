@@ -0,0 +1,176 @@
+import os
+import timeit
+
+import numpy as np
+import pytest
+
+from pyxel.models import Beta
+from pyxel.stats import (cstat, cstat_deriv, cstat_from_vals,
+                         cstat_deriv_from_vals, get_model_vals_and_derivs)
+
+# The per-bin loops that the C-statistic was originally calculated with.
+# They are kept as the reference for the vectorized implementation.
+
+def loop_cstat_deriv(measured_raw_cts, model_vals, model_derivs,
+                     measured_bkg_cts, t_raw, t_bkg):
+    nbins = len(model_vals)
+    nparams = len(model_derivs)
+    d_cash = np.zeros(nparams)
+
+    tmp1 = t_raw + t_bkg
+    tmp2 = tmp1 * model_vals
+    tmp3 = tmp2 - measured_raw_cts - measured_bkg_cts
+    tmp4 = tmp2 * measured_bkg_cts
+    tmp5 = tmp1 * model_derivs
+    tmp6 = tmp5 * measured_bkg_cts
+    tmp7 = t_raw * model_derivs
+    tmp8 = t_bkg * model_derivs
+
+    d = (tmp3 ** 2 + 4. * tmp4)**0.5
+    f = (-tmp3 + d) / (2. * tmp1)
+
+    d_d = (tmp3 ** 2 + 4. * tmp4)**-0.5 * (2. * tmp6 + tmp3 * tmp5)
+    d_f = -0.5 * model_derivs + d_d / (2. * tmp1)
+
+    for i in range(nbins):
+        if measured_raw_cts[i] == 0 and measured_bkg_cts[i] > 0:
+            d_cash += tmp7[:,i]
+        elif measured_bkg_cts[i] == 0 and measured_raw_cts[i] > 0:
+            if tmp2[i] < measured_raw_cts[i]:
+                d_cash -= tmp8[:,i]
+            else:
+                d_cash += tmp7[:,i] - \
+                          measured_raw_cts[i] * 1. / model_vals[i] * \
+                          model_derivs[:,i]
+        else:
+            d_cash += tmp7[:,i] + tmp1[i] * d_f[:,i] - \
+                      measured_raw_cts[i] * \
+                      1. / (model_vals[i] + f[i]) * \
+                      (model_derivs[:,i] + d_f[:,i]) - \
+                      measured_bkg_cts[i] * 1. / f[i] * d_f[:,i]
+    return 2. * d_cash
+
+def loop_cstat(measured_raw_cts, model_vals, measured_bkg_cts, t_raw, t_bkg):
+    tmp1 = t_raw + t_bkg
+    tmp2 = tmp1 * model_vals
+    tmp3 = tmp2 - measured_raw_cts - measured_bkg_cts
+    tmp4 = tmp2 * measured_bkg_cts
+    tmp5 = t_raw * model_vals
+    tmp6 = t_bkg * model_vals
+
+    d = (tmp3 ** 2 + 4. * tmp4)**0.5
+    f = (-tmp3 + d) / (2. * tmp1)
+
+    nbins = len(model_vals)
+    cash = 0.
+    for i in range(nbins):
+        if measured_raw_cts[i] == 0 and measured_bkg_cts[i] > 0:
+            cash += tmp5[i] - measured_bkg_cts[i] * np.log(t_bkg[i] / tmp1[i])
+        elif measured_bkg_cts[i] == 0 and measured_raw_cts[i] > 0:
+            if tmp2[i] < measured_raw_cts[i]:
+                cash -= tmp6[i] + measured_raw_cts[i] * np.log(t_raw[i] / tmp1[i])
+            else:
+                cash += tmp5[i] + measured_raw_cts[i] * \
+                        (np.log(measured_raw_cts[i]/tmp5[i]) - 1)
+        else:
+            cash += tmp5[i] + tmp1[i] * f[i] - \
+                    measured_raw_cts[i] * np.log(t_raw[i] * (model_vals[i] + f[i])) \
+                    - measured_bkg_cts[i] * np.log(t_bkg[i] * f[i]) - \
+                    measured_raw_cts[i] * (1 - np.log(measured_raw_cts[i])) - \
+                    measured_bkg_cts[i] * (1 - np.log(measured_bkg_cts[i]))
+    return 2. * cash
+
+def make_profile(nbins=200, seed=0):
+    """Make a profile with low counts, so that all the branches of the
+    C-statistic are used, with bins without source counts, bins without
+    background counts whose model is below and above the counts, and bins
+    with both."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0.05, 10., nbins)
+    model = Beta(2e-3, 0.7, 0.5, 5e-5)
+    t_raw = rng.uniform(500., 5000., nbins)
+    t_bkg = rng.uniform(1000., 20000., nbins)
+    raw_cts = rng.poisson(model(x) * t_raw).astype(float)
+    bkg_cts = rng.poisson(5e-5 * t_bkg).astype(float)
+    # Bins without any counts make the statistic NaN, see
+    # `test_cstat_empty_bins_match_loop`.
+    bkg_cts[(raw_cts == 0) & (bkg_cts == 0)] = 1.
+    # Make sure that each branch has bins.
+    raw_cts[:5], bkg_cts[:5] = 0., 3.
+    raw_cts[5:10], bkg_cts[5:10] = 4., 0.
+    raw_cts[10:15], bkg_cts[10:15] = 2000., 0.
+    raw_cts[15:20], bkg_cts[15:20] = 7., 2.
+    return model, x, raw_cts, bkg_cts, t_raw, t_bkg
+
+def test_profile_has_all_branches():
+    model, x, raw_cts, bkg_cts, t_raw, t_bkg = make_profile()
+    only_bkg = (raw_cts == 0) & (bkg_cts > 0)
+    only_raw = (bkg_cts == 0) & (raw_cts > 0)
+    below = only_raw & ((t_raw + t_bkg) * model(x) < raw_cts)
+    assert only_bkg.any() and below.any() and (only_raw & ~below).any()
+    assert (~(only_bkg | only_raw)).any()
+
+def test_cstat_matches_loop():
+    model, x, raw_cts, bkg_cts, t_raw, t_bkg = make_profile()
+    model_vals = model(x)
+    expected = loop_cstat(raw_cts, model_vals, bkg_cts, t_raw, t_bkg)
+    assert cstat_from_vals(raw_cts, model_vals, bkg_cts, t_raw,
+                           t_bkg) == expected
+    assert cstat(raw_cts, model, bkg_cts, t_raw, t_bkg, x) == expected
+
+def test_cstat_deriv_matches_loop():
+    model, x, raw_cts, bkg_cts, t_raw, t_bkg = make_profile()
+    model_vals, model_derivs = get_model_vals_and_derivs(model, x)
+    expected = loop_cstat_deriv(raw_cts, model_vals, model_derivs, bkg_cts,
+                                t_raw, t_bkg)
+    assert np.array_equal(
+        cstat_deriv_from_vals(raw_cts, model_vals, model_derivs, bkg_cts,
+                              t_raw, t_bkg), expected)
+    assert np.array_equal(
+        cstat_deriv(raw_cts, model, bkg_cts, t_raw, t_bkg, x), expected)
+
+def test_cstat_empty_bins_match_loop():
+    model, x, raw_cts, bkg_cts, t_raw, t_bkg = make_profile()
+    raw_cts[20], bkg_cts[20] = 0., 0.
+    model_vals, model_derivs = get_model_vals_and_derivs(model, x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = loop_cstat(raw_cts, model_vals, bkg_cts, t_raw, t_bkg)
+        expected_deriv = loop_cstat_deriv(raw_cts, model_vals, model_derivs,
+                                          bkg_cts, t_raw, t_bkg)
+        assert np.isnan(expected)
+        assert np.array_equal(
+            cstat_from_vals(raw_cts, model_vals, bkg_cts, t_raw, t_bkg),
+            expected, equal_nan=True)
+        assert np.array_equal(
+            cstat_deriv_from_vals(raw_cts, model_vals, model_derivs,
+                                  bkg_cts, t_raw, t_bkg),
+            expected_deriv, equal_nan=True)
+
+def test_cstat_several_models_match_loop():
+    model, x, raw_cts, bkg_cts, t_raw, t_bkg = make_profile()
+    model_vals = np.array([model(x) * scale for scale in (0.5, 1., 2.)])
+    expected = [loop_cstat(raw_cts, vals, bkg_cts, t_raw, t_bkg)
+                for vals in model_vals]
+    assert np.array_equal(
+        cstat_from_vals(raw_cts, model_vals, bkg_cts, t_raw, t_bkg),
+        expected)
+
+# Timings depend on the machine and its load, so the benchmark only runs
+# when PYXEL_BENCHMARK is set.
+@pytest.mark.skipif(not os.environ.get('PYXEL_BENCHMARK'),
+                    reason="set PYXEL_BENCHMARK to run the benchmarks")
+def test_benchmark_cstat_against_loop():
+    model, x, raw_cts, bkg_cts, t_raw, t_bkg = make_profile(nbins=2000)
+    model_vals, model_derivs = get_model_vals_and_derivs(model, x)
+    args = (raw_cts, model_vals, bkg_cts, t_raw, t_bkg)
+    deriv_args = (raw_cts, model_vals, model_derivs, bkg_cts, t_raw, t_bkg)
+    timings = {}
+    for name, func, func_args in (
+            ('loop_cstat', loop_cstat, args),
+            ('cstat', cstat_from_vals, args),
+            ('loop_cstat_deriv', loop_cstat_deriv, deriv_args),
+            ('cstat_deriv', cstat_deriv_from_vals, deriv_args)):
+        timings[name] = min(timeit.repeat(lambda: func(*func_args),
+                                          number=5, repeat=3)) / 5
+    assert timings['cstat'] < timings['loop_cstat']
+    assert timings['cstat_deriv'] < timings['loop_cstat_deriv']